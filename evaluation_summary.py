@@ -3,16 +3,54 @@ import glob
 import re
 import json
 import csv
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional
 
 
-def extract_eval_results_to_csv(input_folder: str, output_csv_file: str):
+VISION_USAGE_COLUMNS = ['vision_calls', 'vision_prompt_tokens', 'vision_completion_tokens',
+                        'vision_image_tokens', 'vision_cost']
+
+
+def load_vision_usage(usage_log_file: str) -> Dict[str, Dict[str, float]]:
+    """
+    读取 qwen_mcp_server.py 写出的 JSONL 用量日志 (QWEN_USAGE_LOG)，按任务名汇总视觉工具的调用次数、token 和费用。
+
+    Args:
+        usage_log_file: JSONL 用量日志文件的路径。
+
+    Returns:
+        以任务名为键、汇总用量为值的字典。
+    """
+    usage_by_task: Dict[str, Dict[str, float]] = {}
+
+    with open(usage_log_file, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"跳过用量日志中无法解析的第 {line_number} 行。")
+                continue
+
+            totals = usage_by_task.setdefault(record.get('task') or '', dict.fromkeys(VISION_USAGE_COLUMNS, 0))
+            totals['vision_calls'] += record.get('calls', 1)
+            totals['vision_prompt_tokens'] += record.get('prompt_tokens', 0)
+            totals['vision_completion_tokens'] += record.get('completion_tokens', 0)
+            totals['vision_image_tokens'] += record.get('image_tokens', 0)
+            totals['vision_cost'] += record.get('cost', 0.0)
+
+    return usage_by_task
+
+
+def extract_eval_results_to_csv(input_folder: str, output_csv_file: str, usage_log_file: Optional[str] = None):
     """
     分析一个文件夹中所有的 eval_*.json 文件，并将提取的总分和结果保存到 CSV 文件中。
 
     Args:
         input_folder: 包含 eval_*.json 文件的文件夹路径。
         output_csv_file: 要创建的 CSV 文件的路径。
+        usage_log_file: 可选，Qwen-VL 用量日志 (JSONL) 的路径。提供时会按任务名追加视觉工具的用量列。
     """
 
     # 构建搜索模式以查找所有 eval_*.json 文件
@@ -25,6 +63,19 @@ def extract_eval_results_to_csv(input_folder: str, output_csv_file: str):
 
     results_data: List[List[Any]] = []
 
+    usage_by_task: Dict[str, Dict[str, float]] = {}
+    if usage_log_file:
+        try:
+            usage_by_task = load_vision_usage(usage_log_file)
+        except IOError as e:
+            print(f"读取用量日志 {usage_log_file} 时出错: {e}。将不包含视觉工具用量。")
+            usage_log_file = None
+        else:
+            # 记录只按 QWEN_USAGE_TASK 归属到任务; 未设置时所有记录的任务名为空, 各任务的用量列都会是 0
+            if usage_by_task and set(usage_by_task) == {''}:
+                print(f"警告: 用量日志 {usage_log_file} 中的记录都没有任务名 (启动 qwen_mcp_server.py 时未设置 QWEN_USAGE_TASK)，"
+                      "无法按任务汇总视觉工具用量，各任务的用量列将为 0。")
+
     # 遍历处理每个找到的文件
     for filepath in json_files:
         filename = os.path.basename(filepath)
@@ -51,7 +102,12 @@ def extract_eval_results_to_csv(input_folder: str, output_csv_file: str):
             total = final_score.get('total', 0)
             result = final_score.get('result', 0)
 
-            results_data.append([task_name, total, result])
+            row = [task_name, total, result]
+            if usage_log_file:
+                task_usage = usage_by_task.get(task_name, {})
+                row.extend(round(task_usage.get(column, 0), 4) for column in VISION_USAGE_COLUMNS)
+
+            results_data.append(row)
 
         except json.JSONDecodeError as e:
             print(f"解析 JSON 文件 {filepath} 时出错: {e}。跳过此文件。")
@@ -64,7 +120,10 @@ def extract_eval_results_to_csv(input_folder: str, output_csv_file: str):
             writer = csv.writer(f)
 
             # 写入表头
-            writer.writerow(['task', 'total', 'result'])
+            header = ['task', 'total', 'result']
+            if usage_log_file:
+                header.extend(VISION_USAGE_COLUMNS)
+            writer.writerow(header)
 
             # 写入所有数据行
             writer.writerows(results_data)
@@ -80,10 +139,11 @@ if __name__ == "__main__":
     # 定义输入的文件夹名称和输出的 CSV 文件名
     INPUT_DIR = "outputs_mcp_test"  # 假设 JSON 文件在 "outputs" 文件夹中
     OUTPUT_CSV = "evaluation_summary_mcp_test_1106.csv"
+    USAGE_LOG = "qwen_usage.jsonl"  # qwen_mcp_server.py 的 QWEN_USAGE_LOG，不存在则忽略
 
     # 确保输入文件夹存在
     if not os.path.isdir(INPUT_DIR):
         print(f"错误: 输入文件夹 '{INPUT_DIR}' 不存在。")
     else:
         # 执行提取函数
-        extract_eval_results_to_csv(INPUT_DIR, OUTPUT_CSV)
\ No newline at end of file
+        extract_eval_results_to_csv(INPUT_DIR, OUTPUT_CSV, USAGE_LOG if os.path.exists(USAGE_LOG) else None)
\ No newline at end of file
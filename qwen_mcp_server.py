@@ -6,19 +6,87 @@ import requests
 import base64
 import mimetypes
 import time
+import io
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from openai import OpenAI
 
+try:
+    from PIL import Image
+except ImportError:
+    # Pillow is only required by the optional image pre-processing features
+    Image = None
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is only required by the screenshot diff tool
+    np = None
+
 # --- Qwen3_VL API Configuration ---
 QWEN_API_KEY = os.getenv("DASHSCOPE_API_KEY", "sk-YOUR-ACTUAL-API-KEY-HERE")
 QWEN_BASE_URL = os.getenv("DASHSCOPE_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
 
+QWEN_MODEL = os.getenv("QWEN_VL_MODEL", "qwen-vl-plus")
+
 TOOL_NAME = "analyze_image_with_qwen"
+DIFF_TOOL_NAME = "analyze_image_diff"
 
 # --- Retry Constants ---
 MAX_RETRIES = 1
 RETRY_DELAY_SECONDS = 3
 
+# --- Concurrency Limit ---
+# Upper bound on in-flight Qwen API requests (e.g., when tiles are analyzed in parallel),
+# so we stay under the account's rate limit.
+MAX_CONCURRENT_API_CALLS = int(os.getenv("QWEN_MAX_CONCURRENT_CALLS", "4"))
+API_CALL_SEMAPHORE = threading.BoundedSemaphore(MAX_CONCURRENT_API_CALLS)
+
+# --- Tiling ---
+MAX_TILES = int(os.getenv("QWEN_MAX_TILES", "8"))
+DEFAULT_TILE_OVERLAP = float(os.getenv("QWEN_TILE_OVERLAP", "0.1"))
+
+# --- Usage Accounting ---
+# Every Qwen API call is appended as one JSON line to USAGE_LOG_FILE (if set), tagged with
+# the task name so `evaluation_summary.py` can join vision-tool spend per task.
+# Prices are per 1K tokens in the currency of your cost reports (default 0 = tokens only).
+USAGE_LOG_FILE = os.getenv("QWEN_USAGE_LOG")
+USAGE_TASK_NAME = os.getenv("QWEN_USAGE_TASK", "")
+USAGE_SESSION_ID = os.getenv("QWEN_USAGE_SESSION") or uuid.uuid4().hex[:12]
+PRICE_INPUT_PER_1K_TOKENS = float(os.getenv("QWEN_PRICE_INPUT_PER_1K_TOKENS", "0"))
+PRICE_OUTPUT_PER_1K_TOKENS = float(os.getenv("QWEN_PRICE_OUTPUT_PER_1K_TOKENS", "0"))
+if USAGE_LOG_FILE and not USAGE_TASK_NAME:
+    sys.stderr.write(
+        "[WARNING] QWEN_USAGE_LOG is set but QWEN_USAGE_TASK is not: usage records will not be "
+        "tagged with a task, so evaluation_summary.py cannot attribute them. Set QWEN_USAGE_TASK "
+        "to the task name in the environment that launches this server.\n")
+
+# --- Screenshot Diff ---
+DEFAULT_DIFF_THRESHOLD = int(os.getenv("QWEN_DIFF_THRESHOLD", "24"))  # per-channel intensity change (0-255)
+DIFF_BLOCK_SIZE = 16  # changed pixels are grouped on a grid of this many pixels
+DIFF_PADDING = 8  # context pixels added around each changed region
+MAX_DIFF_REGIONS = 6
+DIFF_THUMBNAIL_SIZE = 512
+DEFAULT_DIFF_PROMPT = "What changed between the BEFORE and AFTER screenshots?"
+
+# --- Perceptual-Hash Deduplication (optional) ---
+# Screenshots taken a few seconds apart usually differ only by a cursor or a clock,
+# so an exact (byte-level) cache never hits them. When enabled, the server keeps a
+# small dHash index of recently analyzed images and reuses the previous answer when
+# a new image is within PHASH_MAX_DISTANCE bits of it and the prompt is identical.
+# A hash match is only a candidate: the answer is reused only if no more than
+# PHASH_MAX_CHANGED_PIXELS pixels of a small grayscale thumbnail changed by more
+# than DEFAULT_DIFF_THRESHOLD, so a new line of text or a new button is not missed.
+PHASH_DEDUP_ENABLED = os.getenv("QWEN_PHASH_DEDUP", "false").lower() in ("1", "true", "yes")
+PHASH_HASH_SIZE = 16  # (hash_size + 1) x hash_size thumbnail, hash_size ** 2 bits
+PHASH_MAX_DISTANCE = int(os.getenv("QWEN_PHASH_MAX_DISTANCE", "8"))
+PHASH_INDEX_SIZE = int(os.getenv("QWEN_PHASH_INDEX_SIZE", "32"))
+PHASH_VERIFY_SIZE = 128  # side of the grayscale thumbnail compared pixel by pixel
+PHASH_MAX_CHANGED_PIXELS = int(os.getenv("QWEN_PHASH_MAX_CHANGED_PIXELS", "0"))
+
 # ==============================================================================
 # (*** Gemini V6.1 优化：强化工具描述 ***)
 # ==============================================================================
@@ -53,10 +121,92 @@ QWEN_TOOL_LIST = [
                         "The **public URL of the image** to be analyzed. This MUST be a URL for a **still image** (e.g., .png, .jpg, .jpeg)."
                         "**Do not** pass a URL to a video file (.mp4). Follow the instructions in the main tool description if you have a video file."
                     )
+                },
+
+                "crop": {
+                    "type": "array",
+                    "items": {"type": "number"},
+                    "minItems": 4,
+                    "maxItems": 4,
+                    "description": (
+                        "Optional region of interest as [left, top, right, bottom]. Use pixel coordinates, "
+                        "or values between 0 and 1 for coordinates relative to the image size "
+                        "(e.g., [0, 0.5, 1, 1] is the bottom half). Only this region is sent to Qwen-VL, "
+                        "which is faster and more focused when you only need one table or dialog."
+                    )
+                },
+                "grid_tile": {
+                    "type": "object",
+                    "properties": {
+                        "rows": {"type": "integer", "minimum": 1},
+                        "cols": {"type": "integer", "minimum": 1},
+                        "row": {"type": "integer", "minimum": 0},
+                        "col": {"type": "integer", "minimum": 0}
+                    },
+                    "required": ["rows", "cols", "row", "col"],
+                    "description": (
+                        "Optional grid cell to analyze: the image (or the 'crop' region, if given) is split into "
+                        "rows x cols equal cells and only the cell at zero-based (row, col) is sent."
+                    )
+                },
+                "tiles": {
+                    "type": "integer",
+                    "minimum": 1,
+                    "description": (
+                        "Optional tiling mode for very tall/wide or dense images (e.g., scrolled full-page screenshots, "
+                        "multi-page scans). The image is split along its longer side into this many overlapping tiles, "
+                        "which are analyzed in parallel at full resolution and merged in reading order. "
+                        f"Maximum {MAX_TILES}. Omit or use 1 to analyze the image in a single pass."
+                    )
+                },
+                "tile_overlap": {
+                    "type": "number",
+                    "minimum": 0,
+                    "maximum": 0.5,
+                    "description": (
+                        "Fraction of each tile shared with its neighbour when 'tiles' > 1, so text cut at a tile "
+                        f"border is still fully visible in one tile. Default {DEFAULT_TILE_OVERLAP}."
+                    )
                 }
             },
             "required": ["prompt", "image_url"]
         }
+    },
+    {
+        "name": DIFF_TOOL_NAME,
+        "description": (
+            "Compares two screenshots of the same screen (e.g., before and after a click) and describes what changed. "
+            "The changed regions are found locally, and only those regions plus a small thumbnail are sent to Qwen-VL, "
+            "so this is much cheaper than analyzing the full new screenshot. If nothing changed, it answers "
+            "'No visible change' immediately. Images are passed the same way as for `analyze_image_with_qwen`."
+        ),
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "before_image_url": {
+                    "type": "string",
+                    "description": "The public URL (or server-accessible path) of the screenshot taken BEFORE the action."
+                },
+                "after_image_url": {
+                    "type": "string",
+                    "description": "The public URL (or server-accessible path) of the screenshot taken AFTER the action."
+                },
+                "prompt": {
+                    "type": "string",
+                    "description": f"Optional question about the change. Default: '{DEFAULT_DIFF_PROMPT}'"
+                },
+                "threshold": {
+                    "type": "integer",
+                    "minimum": 0,
+                    "maximum": 255,
+                    "description": (
+                        "Optional per-channel intensity difference (0-255) above which a pixel counts as changed. "
+                        f"Default {DEFAULT_DIFF_THRESHOLD}; raise it to ignore anti-aliasing or compression noise."
+                    )
+                }
+            },
+            "required": ["before_image_url", "after_image_url"]
+        }
     }
 ]
 
@@ -130,7 +280,7 @@ def encode_image_to_base64(image_path_or_url):
                 raise Exception(f"Server failed to download image URL: {e}")
 
         # 2. Check if already Data URI
-        elif image_path_or_url.startswith('data:image'):
+        elif image_path_or_url.startswith('data:'):
             return image_path_or_url
 
         # 3. Check for 'file://' URI
@@ -156,13 +306,500 @@ def encode_image_to_base64(image_path_or_url):
 
 
 # ==============================================================================
-# V5 Core Logic: call_qwen_vl_api (Unchanged)
+# Image Helpers (Pillow)
+# ==============================================================================
+
+def require_pillow(feature):
+    """Raises a clear error if Pillow is needed for a feature but not installed."""
+    if Image is None:
+        raise ValueError(f"'{feature}' requires Pillow. Please install it with `pip install Pillow`.")
+
+
+def decode_data_uri_to_image(data_uri):
+    """Decodes a base64 Data URI into a fully loaded PIL image."""
+    require_pillow("image decoding")
+    _, _, payload = data_uri.partition(',')
+    image = Image.open(io.BytesIO(base64.b64decode(payload)))
+    image.load()
+    return image
+
+
+def image_to_data_uri(image, image_format=None):
+    """Encodes a PIL image as a base64 Data URI (JPEG sources stay JPEG, everything else becomes PNG)."""
+    image_format = (image_format or image.format or 'PNG').upper()
+    if image_format not in ('JPEG', 'PNG'):
+        image_format = 'PNG'
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format)
+    encoded_string = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return f"data:image/{image_format.lower()};base64,{encoded_string}"
+
+
+# ==============================================================================
+# Region-of-Interest Cropping
+# ==============================================================================
+
+def resolve_region(width, height, crop=None, grid_tile=None):
+    """
+    Resolves the 'crop' and 'grid_tile' inputs into a pixel box (left, top, right, bottom).
+    'crop' is applied first; 'grid_tile' then selects a cell inside the cropped region.
+    """
+    left, top, right, bottom = 0, 0, width, height
+
+    if crop is not None:
+        if not isinstance(crop, (list, tuple)) or len(crop) != 4:
+            raise ValueError(f"'crop' must be [left, top, right, bottom]. Received: {crop}")
+        values = [float(v) for v in crop]
+        if all(0.0 <= v <= 1.0 for v in values):
+            # Normalized coordinates
+            values = [values[0] * width, values[1] * height, values[2] * width, values[3] * height]
+        left = max(0, min(width, int(round(values[0]))))
+        top = max(0, min(height, int(round(values[1]))))
+        right = max(0, min(width, int(round(values[2]))))
+        bottom = max(0, min(height, int(round(values[3]))))
+
+    if grid_tile is not None:
+        try:
+            rows, cols = int(grid_tile["rows"]), int(grid_tile["cols"])
+            row, col = int(grid_tile["row"]), int(grid_tile["col"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"'grid_tile' must contain integer 'rows', 'cols', 'row' and 'col'. Received: {grid_tile}")
+        if rows < 1 or cols < 1 or not (0 <= row < rows) or not (0 <= col < cols):
+            raise ValueError(f"'grid_tile' cell ({row}, {col}) is outside a {rows}x{cols} grid.")
+
+        region_width, region_height = right - left, bottom - top
+        left, right = left + region_width * col // cols, left + region_width * (col + 1) // cols
+        top, bottom = top + region_height * row // rows, top + region_height * (row + 1) // rows
+
+    if right <= left or bottom <= top:
+        raise ValueError(f"The requested region is empty for a {width}x{height} image (crop={crop}, grid_tile={grid_tile}).")
+
+    return left, top, right, bottom
+
+
+def crop_image_region(image_path_or_url, crop=None, grid_tile=None):
+    """
+    Crops an image to the requested region before it is sent to Qwen-VL.
+    Returns (data_uri, region) where region describes the box actually analyzed.
+    """
+    require_pillow("crop/grid_tile")
+    image = decode_data_uri_to_image(encode_image_to_base64(image_path_or_url))
+    width, height = image.size
+    box = resolve_region(width, height, crop, grid_tile)
+
+    sys.stderr.write(f"[INFO] Cropping image {width}x{height} to region {box}.\n")
+    sys.stderr.flush()
+
+    region = {"left": box[0], "top": box[1], "right": box[2], "bottom": box[3],
+              "image_width": width, "image_height": height}
+    return image_to_data_uri(image.crop(box), image.format), region
+
+
+def describe_region(region):
+    """Human-readable note about the region that was analyzed."""
+    return (
+        f"[Region analyzed: left={region['left']}, top={region['top']}, right={region['right']}, "
+        f"bottom={region['bottom']} ({region['right'] - region['left']}x{region['bottom'] - region['top']} px) "
+        f"of the original {region['image_width']}x{region['image_height']} image.]"
+    )
+
+
+# ==============================================================================
+# Perceptual-Hash Deduplication
+# ==============================================================================
+
+def compute_dhash(image, hash_size=PHASH_HASH_SIZE):
+    """
+    Computes a (hash_size ** 2)-bit difference hash (dHash) of a PIL image.
+    Each bit records whether a pixel is brighter than its right neighbour
+    in a (hash_size + 1) x hash_size grayscale thumbnail.
+    """
+    thumbnail = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = thumbnail.tobytes()
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (1 if pixels[offset + col] > pixels[offset + col + 1] else 0)
+    return value
+
+
+def compute_verify_thumbnail(image):
+    """Grayscale PHASH_VERIFY_SIZE x PHASH_VERIFY_SIZE thumbnail bytes, for the pixel check."""
+    return image.convert('L').resize((PHASH_VERIFY_SIZE, PHASH_VERIFY_SIZE), Image.BILINEAR).tobytes()
+
+
+def count_changed_pixels(thumbnail_a, thumbnail_b, threshold=DEFAULT_DIFF_THRESHOLD):
+    """Number of thumbnail pixels whose intensity differs by more than `threshold`."""
+    return sum(1 for a, b in zip(thumbnail_a, thumbnail_b) if abs(a - b) > threshold)
+
+
+class PerceptualHashIndex:
+    """
+    Bounded index of recently analyzed images keyed by dHash.
+    The MCP server runs as one process per agent session, so a module-level
+    instance is effectively a per-session index.
+    """
+
+    def __init__(self, max_entries, max_distance):
+        self.entries = deque(maxlen=max_entries)
+        self.max_distance = max_distance
+        self.lock = threading.Lock()
+
+    def lookup(self, image_hash, prompt, thumbnail):
+        """
+        Returns (entry, distance) of the closest match for the same prompt, or None.
+        Candidates within the hash distance must also pass the thumbnail pixel check.
+        """
+        with self.lock:
+            entries = list(self.entries)
+
+        candidates = []
+        for order, entry in enumerate(reversed(entries)):
+            if entry["prompt"] != prompt:
+                continue
+            distance = (entry["hash"] ^ image_hash).bit_count()
+            if distance <= self.max_distance:
+                candidates.append((distance, order, entry))
+
+        # Closest hash first, most recent first among equals
+        for distance, _, entry in sorted(candidates, key=lambda c: (c[0], c[1])):
+            if count_changed_pixels(entry["thumbnail"], thumbnail) <= PHASH_MAX_CHANGED_PIXELS:
+                return entry, distance
+        return None
+
+    def add(self, image_hash, prompt, thumbnail, answer):
+        with self.lock:
+            self.entries.append({
+                "hash": image_hash,
+                "prompt": prompt,
+                "thumbnail": thumbnail,
+                "answer": answer,
+                "timestamp": time.time(),
+            })
+
+
+PHASH_INDEX = PerceptualHashIndex(PHASH_INDEX_SIZE, PHASH_MAX_DISTANCE)
+
+
+def analyze_image(prompt, image_path_or_url):
+    """
+    Analyzes an image with Qwen-VL, consulting the perceptual-hash index first when enabled.
+    Returns (text_response, metadata).
+    """
+    if not PHASH_DEDUP_ENABLED or Image is None:
+        return call_qwen_vl_api(prompt, image_path_or_url), {}
+
+    encoded_data_uri = encode_image_to_base64(image_path_or_url)
+    try:
+        image = decode_data_uri_to_image(encoded_data_uri)
+        image_hash = compute_dhash(image)
+        thumbnail = compute_verify_thumbnail(image)
+    except Exception as e:
+        sys.stderr.write(f"[WARNING] Could not compute perceptual hash, skipping dedup: {e}\n")
+        sys.stderr.flush()
+        return call_qwen_vl_api(prompt, encoded_data_uri), {}
+
+    match = PHASH_INDEX.lookup(image_hash, prompt, thumbnail)
+    if match is not None:
+        entry, distance = match
+        sys.stderr.write(f"[INFO] Perceptual-hash cache hit (Hamming distance {distance}), skipping Qwen API call.\n")
+        sys.stderr.flush()
+        text_response = (
+            f"[Approximate result: reused the answer for a near-identical image analyzed "
+            f"{time.time() - entry['timestamp']:.0f}s ago (perceptual hash distance {distance}/{PHASH_HASH_SIZE ** 2}).]\n"
+            f"{entry['answer']}"
+        )
+        return text_response, {"approximate": True, "phash_distance": distance}
+
+    text_response = call_qwen_vl_api(prompt, encoded_data_uri)
+    PHASH_INDEX.add(image_hash, prompt, thumbnail, text_response)
+    return text_response, {}
+
+
+# ==============================================================================
+# Tiled Analysis
+# ==============================================================================
+
+def compute_tile_boxes(width, height, tiles, overlap):
+    """
+    Splits an image along its longer side into `tiles` overlapping boxes, in reading order.
+    Each tile is `length / (tiles - (tiles - 1) * overlap)` pixels long and starts
+    `(1 - overlap)` tile-lengths after the previous one, so the tiles exactly cover the image.
+    """
+    vertical = height >= width
+    length = height if vertical else width
+    tile_length = length / (tiles - (tiles - 1) * overlap)
+    stride = tile_length * (1 - overlap)
+
+    boxes = []
+    for index in range(tiles):
+        start = int(round(index * stride))
+        end = length if index == tiles - 1 else min(length, int(round(index * stride + tile_length)))
+        if vertical:
+            boxes.append((0, start, width, end))
+        else:
+            boxes.append((start, 0, end, height))
+    return boxes
+
+
+def analyze_image_tiled(prompt, image_path_or_url, tiles, overlap=DEFAULT_TILE_OVERLAP):
+    """
+    Splits a large image into overlapping tiles, analyzes them concurrently
+    (bounded by MAX_CONCURRENT_API_CALLS) and merges the answers in reading order.
+    Returns (text_response, metadata).
+    """
+    require_pillow("tiles")
+    if not 1 < tiles <= MAX_TILES:
+        raise ValueError(f"'tiles' must be between 2 and {MAX_TILES}. Received: {tiles}")
+    if not 0.0 <= overlap <= 0.5:
+        raise ValueError(f"'tile_overlap' must be between 0 and 0.5. Received: {overlap}")
+
+    image = decode_data_uri_to_image(encode_image_to_base64(image_path_or_url))
+    width, height = image.size
+    boxes = compute_tile_boxes(width, height, tiles, overlap)
+    direction = "top to bottom" if height >= width else "left to right"
+
+    sys.stderr.write(f"[INFO] Tiling image {width}x{height} into {tiles} tiles ({direction}, overlap {overlap}).\n")
+    sys.stderr.flush()
+
+    def analyze_tile(index):
+        tile_prompt = (
+            f"This image is part {index + 1} of {tiles} of a larger image, split {direction} with slightly "
+            f"overlapping edges. Answer only from what is visible in this part.\n\n{prompt}"
+        )
+        return analyze_image(tile_prompt, image_to_data_uri(image.crop(boxes[index]), image.format))
+
+    with ThreadPoolExecutor(max_workers=min(tiles, MAX_CONCURRENT_API_CALLS)) as executor:
+        futures = [executor.submit(analyze_tile, index) for index in range(tiles)]
+
+    sections = []
+    tile_meta = []
+    errors = []
+    for index, (future, box) in enumerate(zip(futures, boxes)):
+        header = f"### Part {index + 1}/{tiles} (pixels {box[0]},{box[1]} to {box[2]},{box[3]})"
+        try:
+            text_response, meta = future.result()
+        except Exception as e:
+            errors.append(e)
+            sections.append(f"{header}\n[Error analyzing this part: {e}]")
+            tile_meta.append({"box": list(box), "error": str(e)})
+            continue
+        sections.append(f"{header}\n{text_response}")
+        tile_meta.append({"box": list(box), **meta})
+
+    if len(errors) == tiles:
+        raise errors[0]
+
+    merged = f"[Tiled analysis: {tiles} parts of a {width}x{height} image, {direction}.]\n\n" + "\n\n".join(sections)
+    return merged, {"tiles": tile_meta}
+
+
+# ==============================================================================
+# Screenshot Diff
+# ==============================================================================
+
+def compute_changed_boxes(before, after, threshold=DEFAULT_DIFF_THRESHOLD):
+    """
+    Finds the bounding boxes (left, top, right, bottom) of regions that differ between two images.
+
+    The pixel difference is computed with vectorized NumPy operations; changed pixels are then
+    pooled into DIFF_BLOCK_SIZE blocks and neighbouring blocks are grouped into regions, so the
+    grouping step only touches the (small) block grid, not every pixel.
+    """
+    if np is None:
+        raise ValueError(f"'{DIFF_TOOL_NAME}' requires NumPy. Please install it with `pip install numpy`.")
+
+    if before.size != after.size:
+        before = before.resize(after.size)
+    after_pixels = np.asarray(after.convert('RGB'), dtype=np.int16)
+    before_pixels = np.asarray(before.convert('RGB'), dtype=np.int16)
+    changed = np.abs(after_pixels - before_pixels).max(axis=2) > threshold
+    if not changed.any():
+        return []
+
+    # Pool changed pixels into blocks
+    height, width = changed.shape
+    grid_height = -(-height // DIFF_BLOCK_SIZE)
+    grid_width = -(-width // DIFF_BLOCK_SIZE)
+    padded = np.zeros((grid_height * DIFF_BLOCK_SIZE, grid_width * DIFF_BLOCK_SIZE), dtype=bool)
+    padded[:height, :width] = changed
+    blocks = padded.reshape(grid_height, DIFF_BLOCK_SIZE, grid_width, DIFF_BLOCK_SIZE).any(axis=(1, 3))
+
+    # Group 8-connected changed blocks into regions
+    labels = np.zeros(blocks.shape, dtype=np.int32)
+    regions = []
+    for start in zip(*np.nonzero(blocks)):
+        if labels[start]:
+            continue
+        label = len(regions) + 1
+        labels[start] = label
+        stack = [start]
+        top, left, bottom, right = start[0], start[1], start[0], start[1]
+        while stack:
+            row, col = stack.pop()
+            top, bottom = min(top, row), max(bottom, row)
+            left, right = min(left, col), max(right, col)
+            for d_row in (-1, 0, 1):
+                for d_col in (-1, 0, 1):
+                    n_row, n_col = row + d_row, col + d_col
+                    if (0 <= n_row < grid_height and 0 <= n_col < grid_width
+                            and blocks[n_row, n_col] and not labels[n_row, n_col]):
+                        labels[n_row, n_col] = label
+                        stack.append((n_row, n_col))
+        regions.append((
+            max(0, int(left) * DIFF_BLOCK_SIZE - DIFF_PADDING),
+            max(0, int(top) * DIFF_BLOCK_SIZE - DIFF_PADDING),
+            min(width, (int(right) + 1) * DIFF_BLOCK_SIZE + DIFF_PADDING),
+            min(height, (int(bottom) + 1) * DIFF_BLOCK_SIZE + DIFF_PADDING),
+        ))
+
+    # Keep the largest regions and fold the rest into one enclosing box
+    regions.sort(key=lambda box: (box[2] - box[0]) * (box[3] - box[1]), reverse=True)
+    if len(regions) > MAX_DIFF_REGIONS:
+        rest = regions[MAX_DIFF_REGIONS - 1:]
+        regions = regions[:MAX_DIFF_REGIONS - 1] + [(
+            min(box[0] for box in rest), min(box[1] for box in rest),
+            max(box[2] for box in rest), max(box[3] for box in rest),
+        )]
+
+    # Reading order: top to bottom, then left to right
+    return sorted(regions, key=lambda box: (box[1], box[0]))
+
+
+def analyze_image_diff(prompt, before_image_url, after_image_url, threshold=DEFAULT_DIFF_THRESHOLD):
+    """
+    Describes what changed between two screenshots by sending only the changed regions
+    (BEFORE and AFTER crops) plus a low-resolution AFTER thumbnail to Qwen-VL.
+    Returns (text_response, metadata); no API call is made when nothing changed.
+    """
+    require_pillow(DIFF_TOOL_NAME)
+    before = decode_data_uri_to_image(encode_image_to_base64(before_image_url))
+    after = decode_data_uri_to_image(encode_image_to_base64(after_image_url))
+    if before.size != after.size:
+        sys.stderr.write(f"[WARNING] Image sizes differ ({before.size} vs {after.size}), resizing BEFORE to match.\n")
+        sys.stderr.flush()
+        before = before.resize(after.size)
+
+    boxes = compute_changed_boxes(before, after, threshold)
+    if not boxes:
+        sys.stderr.write("[INFO] Screenshot diff is empty, skipping Qwen API call.\n")
+        sys.stderr.flush()
+        return f"No visible change between the two images (threshold {threshold}).", {"changed_regions": []}
+
+    width, height = after.size
+    sys.stderr.write(f"[INFO] Screenshot diff found {len(boxes)} changed region(s): {boxes}\n")
+    sys.stderr.flush()
+
+    thumbnail = after.copy()
+    thumbnail.thumbnail((DIFF_THUMBNAIL_SIZE, DIFF_THUMBNAIL_SIZE))
+    images = [image_to_data_uri(thumbnail, after.format)]
+    legend = [f"Image 1: low-resolution thumbnail of the full AFTER screenshot ({width}x{height}), for context only."]
+    for index, box in enumerate(boxes):
+        images.append(image_to_data_uri(before.crop(box), before.format))
+        images.append(image_to_data_uri(after.crop(box), after.format))
+        legend.append(
+            f"Images {len(images) - 1} and {len(images)}: changed region {index + 1} "
+            f"(pixels {box[0]},{box[1]} to {box[2]},{box[3]}), BEFORE then AFTER."
+        )
+
+    diff_prompt = (
+        "You are comparing two screenshots of the same screen taken before and after an action. "
+        "Only the regions that changed are provided at full resolution.\n"
+        + "\n".join(legend)
+        + f"\n\n{prompt}"
+    )
+    text_response = call_qwen_vl_api(diff_prompt, images)
+
+    region_list = "; ".join(f"{box[0]},{box[1]} to {box[2]},{box[3]}" for box in boxes)
+    summary = f"[Detected {len(boxes)} changed region(s) in the {width}x{height} image: {region_list}.]"
+    return f"{summary}\n{text_response}", {"changed_regions": [list(box) for box in boxes]}
+
+
+# ==============================================================================
+# Usage Accounting
+# ==============================================================================
+
+USAGE_FIELDS = ("calls", "prompt_tokens", "completion_tokens", "image_tokens", "total_tokens",
+                "latency_seconds", "cost")
+SESSION_USAGE = dict.fromkeys(USAGE_FIELDS, 0)
+USAGE_LOCK = threading.Lock()
+
+# The tool call currently being served (the main loop handles one request at a time)
+CURRENT_TOOL_NAME = None
+
+
+def _usage_value(obj, name):
+    """Reads a field from an OpenAI usage object or a plain dict, defaulting to 0."""
+    if obj is None:
+        return 0
+    value = obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+    return value or 0
+
+
+def record_usage(completion, latency_seconds):
+    """
+    Records the token usage of one Qwen API call: adds it to the session totals
+    and appends it to the JSONL usage log. Returns the usage record.
+    """
+    usage = getattr(completion, "usage", None)
+    prompt_tokens = _usage_value(usage, "prompt_tokens")
+    completion_tokens = _usage_value(usage, "completion_tokens")
+    record = {
+        "timestamp": time.time(),
+        "session_id": USAGE_SESSION_ID,
+        "task": USAGE_TASK_NAME,
+        "tool": CURRENT_TOOL_NAME,
+        "model": getattr(completion, "model", None) or QWEN_MODEL,
+        "calls": 1,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        # DashScope reports image tokens under prompt_tokens_details
+        "image_tokens": _usage_value(_usage_value(usage, "prompt_tokens_details") or None, "image_tokens"),
+        "total_tokens": _usage_value(usage, "total_tokens") or prompt_tokens + completion_tokens,
+        "latency_seconds": round(latency_seconds, 3),
+        "cost": (prompt_tokens * PRICE_INPUT_PER_1K_TOKENS + completion_tokens * PRICE_OUTPUT_PER_1K_TOKENS) / 1000,
+    }
+
+    with USAGE_LOCK:
+        for field in USAGE_FIELDS:
+            SESSION_USAGE[field] += record[field]
+
+        if USAGE_LOG_FILE:
+            try:
+                with open(USAGE_LOG_FILE, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except IOError as e:
+                sys.stderr.write(f"[ERROR] Failed to write usage log {USAGE_LOG_FILE}: {e}\n")
+                sys.stderr.flush()
+
+    sys.stderr.write(
+        f"[INFO] Qwen usage: {prompt_tokens} prompt / {completion_tokens} completion tokens "
+        f"({record['image_tokens']} image) in {latency_seconds:.2f}s.\n")
+    sys.stderr.flush()
+    return record
+
+
+def get_session_usage():
+    """Returns a snapshot of the running usage totals for this session."""
+    with USAGE_LOCK:
+        return dict(SESSION_USAGE)
+
+
+# ==============================================================================
+# Core Logic: call_qwen_vl_api
 # ==============================================================================
 
 def call_qwen_vl_api(prompt, image_path_or_url):
     """
-    (V5 Logic - Unchanged)
-    Calls the Qwen3_VL API with retry logic.
+    Calls the Qwen3_VL API with retry logic and returns the text response.
+    `image_path_or_url` may also be a list of images (e.g. the crops of a diff),
+    which are sent in order in a single message. Cropping and tiling happen in
+    the callers; every completed call is recorded in the session usage totals.
     """
     if not QWEN_API_KEY or QWEN_API_KEY == "sk-YOUR-ACTUAL-API-KEY-HERE":
         raise ValueError("QWEN_API_KEY is not set. Please set DASHSCOPE_API_KEY in environment or script.")
@@ -171,10 +808,13 @@ def call_qwen_vl_api(prompt, image_path_or_url):
         raise ValueError(
             f"QWEN_BASE_URL seems incorrect. OpenAI lib needs 'compatible-mode/v1' URL. Current: {QWEN_BASE_URL}")
 
-    sys.stderr.write(f"[INFO] Processing image (V5 Mode): {image_path_or_url[:70]}...\n")
+    # A list of images is sent in order, in a single user message
+    images = image_path_or_url if isinstance(image_path_or_url, (list, tuple)) else [image_path_or_url]
+
+    sys.stderr.write(f"[INFO] Processing {len(images)} image(s) (V5 Mode): {images[0][:70]}...\n")
     sys.stderr.flush()
 
-    encoded_data_uri = encode_image_to_base64(image_path_or_url)
+    encoded_data_uris = [encode_image_to_base64(image) for image in images]
 
     try:
         client = OpenAI(
@@ -188,7 +828,7 @@ def call_qwen_vl_api(prompt, image_path_or_url):
         {
             "role": "user",
             "content": [
-                {"type": "image_url", "image_url": {"url": encoded_data_uri}},
+                *({"type": "image_url", "image_url": {"url": data_uri}} for data_uri in encoded_data_uris),
                 {"type": "text", "text": prompt}
             ]
         }
@@ -204,10 +844,15 @@ def call_qwen_vl_api(prompt, image_path_or_url):
                 sys.stderr.write(f"[INFO] Starting attempt {attempts}/{MAX_RETRIES} (for Qwen API)...\n")
                 sys.stderr.flush()
 
-            completion = client.chat.completions.create(
-                model="qwen-vl-plus",
-                messages=messages
-            )
+            with API_CALL_SEMAPHORE:
+                started = time.monotonic()
+                completion = client.chat.completions.create(
+                    model=QWEN_MODEL,
+                    messages=messages
+                )
+                latency_seconds = time.monotonic() - started
+
+            record_usage(completion, latency_seconds)
 
             if completion.choices and completion.choices[0].message:
                 text_response = completion.choices[0].message.content
@@ -244,6 +889,8 @@ def call_qwen_vl_api(prompt, image_path_or_url):
 # ==============================================================================
 
 def main():
+    global CURRENT_TOOL_NAME
+
     send_raw_message({"mcp": "0.1.0"})
     sys.stderr.write("[INFO] Qwen-VL MCP Server (V6.1 - Video/Image Fix) starting, waiting for connection...\n")
     sys.stderr.flush()
@@ -282,22 +929,58 @@ def main():
                     try:
                         tool_name = request["params"].get("name")
                         tool_input = request["params"].get("input") or request["params"].get("arguments") or {}
+                        CURRENT_TOOL_NAME = tool_name
+                        usage_before = get_session_usage()
 
-                        if tool_name != TOOL_NAME:
-                            raise ValueError(f"Unknown tool name: {tool_name}")
+                        if tool_name == TOOL_NAME:
+                            prompt = tool_input.get("prompt")
+                            image_url = tool_input.get("image_url")
 
-                        prompt = tool_input.get("prompt")
-                        image_url = tool_input.get("image_url")
+                            if not prompt or not image_url:
+                                raise ValueError(f"Missing 'prompt' or 'image_url' parameters. Received: {tool_input}")
 
-                        if not prompt or not image_url:
-                            raise ValueError(f"Missing 'prompt' or 'image_url' parameters. Received: {tool_input}")
+                            sys.stderr.write(
+                                f"[INFO] Received tool call: {TOOL_NAME} (Prompt: '{prompt[:30]}...', URL/Path: '{image_url}')\n")
+                            sys.stderr.flush()
 
-                        sys.stderr.write(
-                            f"[INFO] Received tool call: {TOOL_NAME} (Prompt: '{prompt[:30]}...', URL/Path: '{image_url}')\n")
-                        sys.stderr.flush()
+                            crop = tool_input.get("crop")
+                            grid_tile = tool_input.get("grid_tile")
+                            region = None
+                            if crop is not None or grid_tile is not None:
+                                image_url, region = crop_image_region(image_url, crop, grid_tile)
+
+                            # (V6) Call V5 function to get the result string
+                            tiles = int(tool_input.get("tiles") or 1)
+                            if tiles > 1:
+                                overlap = float(tool_input.get("tile_overlap", DEFAULT_TILE_OVERLAP))
+                                result_content_string, result_meta = analyze_image_tiled(prompt, image_url, tiles, overlap)
+                            else:
+                                result_content_string, result_meta = analyze_image(prompt, image_url)
+
+                            if region is not None:
+                                result_content_string = f"{describe_region(region)}\n{result_content_string}"
+                                result_meta["region"] = region
+
+                        elif tool_name == DIFF_TOOL_NAME:
+                            before_image_url = tool_input.get("before_image_url")
+                            after_image_url = tool_input.get("after_image_url")
+
+                            if not before_image_url or not after_image_url:
+                                raise ValueError(
+                                    f"Missing 'before_image_url' or 'after_image_url' parameters. Received: {tool_input}")
 
-                        # (V6) Call V5 function to get the result string
-                        result_content_string = call_qwen_vl_api(prompt, image_url)
+                            prompt = tool_input.get("prompt") or DEFAULT_DIFF_PROMPT
+                            threshold = int(tool_input.get("threshold", DEFAULT_DIFF_THRESHOLD))
+
+                            sys.stderr.write(
+                                f"[INFO] Received tool call: {DIFF_TOOL_NAME} (Before: '{before_image_url}', After: '{after_image_url}')\n")
+                            sys.stderr.flush()
+
+                            result_content_string, result_meta = analyze_image_diff(
+                                prompt, before_image_url, after_image_url, threshold)
+
+                        else:
+                            raise ValueError(f"Unknown tool name: {tool_name}")
 
                         # (V6) Wrap the string result in a list
                         structured_content_list = [
@@ -307,8 +990,16 @@ def main():
                             }
                         ]
 
+                        # Attach this call's and the session's running usage totals
+                        usage_after = get_session_usage()
+                        result_meta["usage"] = {
+                            "call": {field: usage_after[field] - usage_before[field] for field in USAGE_FIELDS},
+                            "session": usage_after,
+                            "session_id": USAGE_SESSION_ID,
+                        }
+
                         # Send the correctly formatted list
-                        send_jsonrpc_response(request_id, {"content": structured_content_list})
+                        send_jsonrpc_response(request_id, {"content": structured_content_list, "_meta": result_meta})
 
                     except Exception as e:
                         sys.stderr.write(f"[ERROR] Tool execution error after processing/retries: {e}\n")
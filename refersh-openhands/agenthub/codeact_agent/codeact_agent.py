@@ -10,6 +10,7 @@ if TYPE_CHECKING:
     from openhands.llm.llm import ModelResponse
 
 import openhands.agenthub.codeact_agent.function_calling as codeact_function_calling
+from openhands.agenthub.codeact_agent.completion_cache import CompletionCache
 from openhands.agenthub.codeact_agent.tools.bash import create_cmd_run_tool
 from openhands.agenthub.codeact_agent.tools.browser import BrowserTool
 from openhands.agenthub.codeact_agent.tools.finish import FinishTool
@@ -21,6 +22,7 @@ from openhands.agenthub.codeact_agent.tools.str_replace_editor import (
 from openhands.agenthub.codeact_agent.tools.think import ThinkTool
 from openhands.controller.agent import Agent
 from openhands.controller.state.state import State
+from openhands.controller.step_tracer import trace_span
 from openhands.core.config import AgentConfig
 from openhands.core.logger import openhands_logger as logger
 from openhands.core.message import Message
@@ -91,6 +93,9 @@ class CodeActAgent(Agent):
         self.condenser = Condenser.from_config(self.config.condenser)
         logger.debug(f'Using condenser: {type(self.condenser)}')
 
+        # Optional on-disk cache of completions (LLM_COMPLETION_CACHE_MODE)
+        self.completion_cache = CompletionCache.from_env()
+
     @property
     def prompt_manager(self) -> PromptManager:
         if self._prompt_manager is None:
@@ -174,7 +179,9 @@ class CodeActAgent(Agent):
         # event we'll just return that instead of an action. The controller will
         # immediately ask the agent to step again with the new view.
         condensed_history: list[Event] = []
-        match self.condenser.condensed_history(state):
+        with trace_span('agent.condenser'):
+            condensation_result = self.condenser.condensed_history(state)
+        match condensation_result:
             case View(events=events):
                 condensed_history = events
 
@@ -185,16 +192,27 @@ class CodeActAgent(Agent):
             f'Processing {len(condensed_history)} events from a total of {len(state.history)} events'
         )
 
-        initial_user_message = self._get_initial_user_message(state.history)
-        messages = self._get_messages(condensed_history, initial_user_message)
-        params: dict = {
-            'messages': self.llm.format_messages_for_llm(messages),
-        }
-        params['tools'] = check_tools(self.tools, self.llm.config)
-        params['extra_body'] = {'metadata': state.to_llm_metadata(agent_name=self.name)}
-        response = self.llm.completion(**params)
+        with trace_span('agent.build_messages', events=len(condensed_history)):
+            initial_user_message = self._get_initial_user_message(state.history)
+            messages = self._get_messages(condensed_history, initial_user_message)
+            params: dict = {
+                'messages': self.llm.format_messages_for_llm(messages),
+            }
+            params['tools'] = check_tools(self.tools, self.llm.config)
+            params['extra_body'] = {
+                'metadata': state.to_llm_metadata(agent_name=self.name)
+            }
+        with trace_span('llm.completion', model=self.llm.config.model):
+            if self.completion_cache is not None:
+                response = self.completion_cache.completion(
+                    self.llm.completion, self.llm.config, **params
+                )
+                state.extra_data['completion_cache'] = self.completion_cache.stats()
+            else:
+                response = self.llm.completion(**params)
         logger.debug(f'Response from LLM: {response}')
-        actions = self.response_to_actions(response)
+        with trace_span('agent.response_to_actions'):
+            actions = self.response_to_actions(response)
         logger.debug(f'Actions after response_to_actions: {actions}')
         for action in actions:
             self.pending_actions.append(action)
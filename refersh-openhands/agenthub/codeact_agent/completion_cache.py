@@ -0,0 +1,175 @@
+"""On-disk cache of LLM completions, for cheap deterministic re-evaluation.
+
+The cache is keyed by a SHA-256 of the formatted messages, the tools and the
+model settings that affect the output, so a re-run of a task is served from disk
+for as long as its prompts stay identical, and calls the LLM from the first step
+that differs. Configured with:
+
+- LLM_COMPLETION_CACHE_MODE:
+    'off' (default), no caching;
+    'read_write', serve hits and store misses;
+    'strict', serve hits and fail on a miss (the run must be fully cached);
+    'record_only', always call the LLM and store the response.
+- LLM_COMPLETION_CACHE_DIR: cache directory, ./llm_completion_cache by default.
+
+Entries are written atomically, one file per key, so parallel runs can share a
+cache directory.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Callable
+
+from litellm import ModelResponse
+
+from openhands.core.logger import openhands_logger as logger
+
+CACHE_MODE_OFF = 'off'
+CACHE_MODE_READ_WRITE = 'read_write'
+CACHE_MODE_STRICT = 'strict'
+CACHE_MODE_RECORD_ONLY = 'record_only'
+CACHE_MODES = (
+    CACHE_MODE_OFF,
+    CACHE_MODE_READ_WRITE,
+    CACHE_MODE_STRICT,
+    CACHE_MODE_RECORD_ONLY,
+)
+DEFAULT_CACHE_DIR = 'llm_completion_cache'
+
+# LLM config fields that change the completion for the same messages
+KEY_CONFIG_FIELDS = (
+    'model',
+    'temperature',
+    'top_p',
+    'top_k',
+    'max_output_tokens',
+    'reasoning_effort',
+    'seed',
+)
+
+
+class CompletionCacheMissError(RuntimeError):
+    """Raised in 'strict' mode when a completion is not in the cache."""
+
+
+class CompletionCache:
+    """Looks up and stores LLM completions by a hash of their request.
+
+    Args:
+        cache_dir: Directory of the cache entries.
+        mode: One of CACHE_MODES.
+    """
+
+    def __init__(self, cache_dir: str, mode: str = CACHE_MODE_READ_WRITE):
+        if mode not in CACHE_MODES:
+            raise ValueError(
+                f'Unknown completion cache mode: {mode}. Expected one of {CACHE_MODES}'
+            )
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'CompletionCache | None':
+        """The cache configured by the environment, or None when it is off."""
+        mode = os.getenv('LLM_COMPLETION_CACHE_MODE', CACHE_MODE_OFF)
+        if mode == CACHE_MODE_OFF:
+            return None
+        return cls(os.getenv('LLM_COMPLETION_CACHE_DIR', DEFAULT_CACHE_DIR), mode)
+
+    @staticmethod
+    def make_key(params: dict, llm_config: Any) -> str:
+        """Stable hash of the messages, tools and output-affecting model settings.
+
+        Per-run metadata (`extra_body`, e.g. session ids) is deliberately left out.
+        """
+        payload = {
+            'messages': params.get('messages'),
+            'tools': params.get('tools'),
+            'config': {
+                field: getattr(llm_config, field, None) for field in KEY_CONFIG_FIELDS
+            },
+        }
+        encoded = json.dumps(
+            payload, sort_keys=True, ensure_ascii=False, default=str
+        ).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def _load(self, key: str) -> ModelResponse | None:
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return ModelResponse(**json.load(f))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f'Ignoring unreadable completion cache entry {key}: {e}')
+            return None
+
+    def _store(self, key: str, response: ModelResponse) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(response.model_dump(), f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'Could not store completion cache entry {key}: {e}')
+
+    def completion(
+        self,
+        completion_fn: Callable[..., ModelResponse],
+        llm_config: Any,
+        **params: Any,
+    ) -> ModelResponse:
+        """Returns the cached completion for `params`, or calls `completion_fn(**params)`."""
+        key = self.make_key(params, llm_config)
+
+        if self.mode != CACHE_MODE_RECORD_ONLY:
+            cached = self._load(key)
+            if cached is not None:
+                with self._lock:
+                    self.hits += 1
+                logger.debug(
+                    f'Completion cache hit {key[:12]} ({self.summary()})'
+                )
+                return cached
+            if self.mode == CACHE_MODE_STRICT:
+                with self._lock:
+                    self.misses += 1
+                raise CompletionCacheMissError(
+                    f'Completion {key[:12]} is not in the cache {self.cache_dir} '
+                    f'(strict mode, {self.summary()})'
+                )
+
+        with self._lock:
+            self.misses += 1
+        response = completion_fn(**params)
+        self._store(key, response)
+        logger.debug(f'Completion cache miss {key[:12]} ({self.summary()})')
+        return response
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            'mode': self.mode,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hit_rate, 4),
+        }
+
+    def summary(self) -> str:
+        return f'{self.hits} hits / {self.misses} misses, hit rate {self.hit_rate:.1%}'
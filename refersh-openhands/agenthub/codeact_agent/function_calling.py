@@ -229,8 +229,20 @@ def response_to_actions(
                 )
 
             elif tool_call.function.name == RecallTaskDetailsTool['function']['name']:
+                # 5. 分块召回参数必须是整数
+                range_kwargs = {}
+                for key in ('chunk', 'offset', 'max_chars'):
+                    if arguments.get(key) is not None:
+                        try:
+                            range_kwargs[key] = int(arguments[key])
+                        except (TypeError, ValueError) as e:
+                            raise FunctionCallValidationError(
+                                f"Invalid integer passed to '{key}' argument: {arguments[key]}"
+                            ) from e
                 action = RecallTaskAction(
-                    title=arguments.get('title', None)  # 3. 传递可选的 title
+                    title=arguments.get('title', None),  # 3. 传递可选的 title
+                    query=arguments.get('query', None),  # 4. 传递可选的检索关键词
+                    **range_kwargs,
                 )
 
             # ================================================
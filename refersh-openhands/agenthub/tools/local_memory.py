@@ -29,14 +29,30 @@ RecallTaskDetailsTool = ChatCompletionToolParam(
     type='function',
     function=ChatCompletionToolParamFunctionChunk(
         name='recall_task_details',
-        description='Retrieves memories. If no title is given, returns an outline (list) of all memory titles. If a title is given, returns the specific content for that title.',
+        description='Retrieves memories. If no title is given, returns an outline (list) of all memory titles. If a title is given, returns the specific content for that title. If a query is given instead, returns the best-matching memories with short snippets.',
         parameters={
             'type': 'object',
             'properties': {
                 'title': { # <-- 添加 title
                     'type': 'string',
                     'description': 'The UpperCamelCase title of the memory to recall. If omitted, returns the outline.',
-                }
+                },
+                'query': { # <-- 关键词检索
+                    'type': 'string',
+                    'description': 'Keywords to search for in memory titles and contents (e.g., "gitlab password"). Used only when title is omitted; returns the top matching titles with snippets.',
+                },
+                'chunk': { # <-- 分块召回
+                    'type': 'integer',
+                    'description': 'For large memories: the zero-based chunk of the content to return. The outline shows each memory\'s size and number of chunks.',
+                },
+                'offset': {
+                    'type': 'integer',
+                    'description': 'For large memories: the character offset to start reading from (use with max_chars).',
+                },
+                'max_chars': {
+                    'type': 'integer',
+                    'description': 'For large memories: the maximum number of characters to return.',
+                },
             },
             # 'required' 列表是空的，所以 title 是可选的
         },
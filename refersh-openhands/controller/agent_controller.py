@@ -1,11 +1,15 @@
 from __future__ import annotations
 
 import asyncio
+import base64
 import copy
+import hashlib
+import json
+import logging
 import os
 import time
 import traceback
-from typing import Callable
+from typing import Callable, Iterator
 
 import litellm  # noqa
 from litellm.exceptions import (  # noqa
@@ -24,9 +28,18 @@ from litellm.exceptions import (  # noqa
 )
 
 from openhands.controller.agent import Agent
+from openhands.controller.history_index import HistoryIndex
+from openhands.controller.history_snapshot import (
+    get_snapshot_path,
+    load_history_snapshot,
+    load_snapshot_events,
+    write_history_snapshot,
+)
 from openhands.controller.replay import ReplayManager
 from openhands.controller.state.state import State, TrafficControlState
+from openhands.controller.step_tracer import get_tracer, now_us, trace_span, trace_step
 from openhands.controller.stuck import StuckDetector
+from openhands.controller.stuck_fingerprints import LoopFingerprints
 from openhands.core.config import AgentConfig, LLMConfig
 from openhands.core.exceptions import (
     AgentStuckInLoopError,
@@ -74,7 +87,7 @@ from openhands.events.observation import (
 )
 from openhands.events.serialization.event import event_to_trajectory, truncate_content
 from openhands.llm.llm import LLM
-from openhands.llm.metrics import Metrics, TokenUsage
+from openhands.llm.metrics import Metrics
 
 from openhands.controller.local_memory_handler import LocalMemoryHandler
 
@@ -82,7 +95,19 @@ from openhands.controller.local_memory_handler import LocalMemoryHandler
 TRAFFIC_CONTROL_REMINDER = (
     "Please click on resume button if you'd like to continue, or start a new task."
 )
+# screenshot fields of browser observations moved to the sidecar directory on export
+TRAJECTORY_SCREENSHOT_FIELDS = ('screenshot', 'set_of_marks')
 ERROR_ACTION_NOT_EXECUTED_ID = 'AGENT_ERROR$ERROR_ACTION_NOT_EXECUTED'
+# How _apply_conversation_window truncates the history on context window errors:
+# 'halve' keeps roughly half of the events, 'token_budget' keeps the newest events
+# whose estimated tokens fit HISTORY_TRUNCATION_TARGET_FRACTION of max_input_tokens
+# (but never more than 'halve' would, so repeated overflows always shrink the history)
+HISTORY_TRUNCATION_HALVE = 'halve'
+HISTORY_TRUNCATION_TOKEN_BUDGET = 'token_budget'
+DEFAULT_HISTORY_TRUNCATION_TARGET_FRACTION = 0.5
+# Pre-flight check (PREFLIGHT_CONTEXT_CHECK=true): truncate before calling the LLM when the
+# estimated history exceeds PREFLIGHT_CONTEXT_THRESHOLD of max_input_tokens
+DEFAULT_PREFLIGHT_CONTEXT_THRESHOLD = 0.9
 ERROR_ACTION_NOT_EXECUTED = 'The action has not been executed. This may have occurred because the user pressed the stop button, or because the runtime system crashed and restarted due to resource constraints. Any previously established system state, dependencies, or environment variables may have been lost.'
 
 
@@ -99,6 +124,7 @@ class AgentController:
     delegate: 'AgentController | None' = None
     _pending_action_info: tuple[Action, float] | None = None  # (action, timestamp)
     _closed: bool = False
+    _history_rebuilt: bool = True
     _cached_first_user_message: MessageAction | None = None
 
     def __init__(
@@ -144,6 +170,35 @@ class AgentController:
         # the event stream must be set before maybe subscribing to it
         self.event_stream = event_stream
 
+        # positions of essential events in state.history, maintained in _on_event
+        self._history_index = HistoryIndex()
+        self._loop_fingerprints = LoopFingerprints()
+        # periodic history snapshots for fast resume (CONTROLLER_SNAPSHOT_INTERVAL steps, 0 = off)
+        self._snapshot_interval = int(os.getenv('CONTROLLER_SNAPSHOT_INTERVAL', '0'))
+        self._snapshot_path = get_snapshot_path(
+            self.id, getattr(event_stream, 'user_id', None)
+        )
+        self._steps_since_snapshot = 0
+        # (key, metrics) of the last snapshot attached to an action, see _prepare_metrics_for_frontend
+        self._metrics_snapshot: tuple[tuple, Metrics] | None = None
+        self._history_truncation_mode = os.getenv(
+            'HISTORY_TRUNCATION_MODE', HISTORY_TRUNCATION_HALVE
+        )
+        self._history_truncation_target_fraction = float(
+            os.getenv(
+                'HISTORY_TRUNCATION_TARGET_FRACTION',
+                DEFAULT_HISTORY_TRUNCATION_TARGET_FRACTION,
+            )
+        )
+        self._preflight_context_check = os.getenv(
+            'PREFLIGHT_CONTEXT_CHECK', 'false'
+        ).lower() in ('true', '1')
+        self._preflight_context_threshold = float(
+            os.getenv('PREFLIGHT_CONTEXT_THRESHOLD', DEFAULT_PREFLIGHT_CONTEXT_THRESHOLD)
+        )
+        # estimate that last triggered a pre-flight truncation, to avoid truncating in a loop
+        self._last_preflight_estimate: int | None = None
+
         # subscribe to the event stream if this is not a delegate
         if not self.is_delegate:
             self.event_stream.subscribe(
@@ -184,11 +239,16 @@ class AgentController:
         # Add the system message to the event stream
         self._add_system_message()
 
-        # 在这里初始化你的新处理器
-        self.local_memory_handler = LocalMemoryHandler()
+        # 在这里初始化你的新处理器 (按会话分片, 并行评测互不干扰)
+        self.local_memory_handler = LocalMemoryHandler.for_session(self.id)
 
     def _add_system_message(self):
-        for event in self.event_stream.get_events(start_id=self.state.start_id):
+        # The restored history holds the same events (minus filtered/delegate ones, which
+        # are neither user nor system messages): only scan the event stream without it
+        events = self.state.history or self.event_stream.get_events(
+            start_id=self.state.start_id
+        )
+        for event in events:
             if isinstance(event, MessageAction) and event.source == EventSource.USER:
                 # FIXME: Remove this after 6/1/2025
                 # Do not try to add a system message if we first run into
@@ -213,10 +273,24 @@ class AgentController:
             logger.debug(f'System message: {preview}')
             self.event_stream.add_event(system_message, EventSource.AGENT)
 
-    async def close(self, set_stop_state: bool = True) -> None:
+    async def close(
+        self, set_stop_state: bool = True, rebuild_history: bool = True
+    ) -> None:
         """Closes the agent controller, canceling any ongoing tasks and unsubscribing from the event stream.
 
         Note that it's fairly important that this closes properly, otherwise the state is incomplete.
+
+        Args:
+            set_stop_state: Whether to set the agent state to STOPPED.
+            rebuild_history: Whether to load the complete history (with delegate events)
+                into state.history. Keep the default wherever state.history or
+                get_trajectory is read after closing (e.g. run_controller). Callers
+                that only export the trajectory with export_trajectory can opt in to
+                False, which streams it from the event stream instead of holding it
+                in memory.
+
+        If $TRAJECTORY_EXPORT_DIR is set, the root controller also streams its
+        trajectory to `<dir>/<session id>.jsonl` (see export_trajectory).
         """
         if set_stop_state:
             await self.set_agent_state_to(AgentState.STOPPED)
@@ -227,20 +301,9 @@ class AgentController:
         # like the regular agent history, it does not include:
         # - 'hidden' events, events with hidden=True
         # - backend events (the default 'filtered out' types, types in self.filter_out)
-        start_id = self.state.start_id if self.state.start_id >= 0 else 0
-        end_id = (
-            self.state.end_id
-            if self.state.end_id >= 0
-            else self.event_stream.get_latest_event_id()
-        )
-        self.state.history = list(
-            self.event_stream.search_events(
-                start_id=start_id,
-                end_id=end_id,
-                reverse=False,
-                filter=self.agent_history_filter,
-            )
-        )
+        if rebuild_history:
+            self.state.history = list(self._iter_complete_history())
+        self._history_rebuilt = rebuild_history
 
         # unsubscribe from the event stream
         # only the root parent controller subscribes to the event stream
@@ -248,8 +311,21 @@ class AgentController:
             self.event_stream.unsubscribe(
                 EventStreamSubscriber.AGENT_CONTROLLER, self.id
             )
+
+        # release the local memory's worker thread (delegates have their own handler)
+        # only now, so that no memory action delivered before the unsubscribe finds it closed
+        self.local_memory_handler.close()
         self._closed = True
 
+        export_dir = os.getenv('TRAJECTORY_EXPORT_DIR')
+        if export_dir and not self.is_delegate:
+            try:
+                os.makedirs(export_dir, exist_ok=True)
+                count = self.export_trajectory(os.path.join(export_dir, f'{self.id}.jsonl'))
+                self.log('info', f'Exported {count} trajectory events to {export_dir}')
+            except Exception as e:
+                self.log('error', f'Failed to export the trajectory: {e}')
+
     def log(self, level: str, message: str, extra: dict | None = None) -> None:
         """Logs a message to the agent controller's logger.
 
@@ -320,7 +396,10 @@ class AgentController:
 
     async def _step_with_exception_handling(self) -> None:
         try:
-            await self._step()
+            # label the spans with the iteration this step runs as (update_state_before_step
+            # increments it), which is also the step the runtime's pending-action span records
+            with trace_step(self.id, self.state.iteration + 1):
+                await self._step()
         except Exception as e:
             self.log(
                 'error',
@@ -422,6 +501,7 @@ class AgentController:
         # if the event is not filtered out, add it to the history
         if self.agent_history_filter.include(event):
             self.state.history.append(event)
+            self._history_index.sync(self.state.history)
 
         if isinstance(event, Action):
             await self._handle_action(event)
@@ -476,7 +556,8 @@ class AgentController:
         # ====================================================================
         elif isinstance(action, SaveTaskAction):
             # 1. 委托给 save_memory, 传递 title 和 description
-            obs_content = self.local_memory_handler.save_memory(
+            # (在记忆文件的执行器中运行, 文件 I/O 不阻塞事件循环)
+            obs_content = await self.local_memory_handler.asave_memory(
                 action.title,
                 action.task_description
             )
@@ -484,8 +565,14 @@ class AgentController:
             self.event_stream.add_event(obs, EventSource.AGENT)
 
         elif isinstance(action, RecallTaskAction):
-            # 2. 委托给 recall_memory, 传递 action.title (可能是 None)
-            obs_content = self.local_memory_handler.recall_memory(action.title)
+            # 2. 委托给 recall_memory, 传递 action.title / action.query (可能是 None)
+            obs_content = await self.local_memory_handler.arecall_memory(
+                action.title,
+                query=action.query,
+                chunk=action.chunk,
+                offset=action.offset,
+                max_chars=action.max_chars,
+            )
             obs = AgentCondensationObservation(content=obs_content)
             self.event_stream.add_event(obs, EventSource.AGENT)
 
@@ -496,16 +583,21 @@ class AgentController:
         Args:
             observation (observation): The observation to handle.
         """
-        observation_to_print = copy.deepcopy(observation)
-        if len(observation_to_print.content) > self.agent.llm.config.max_message_chars:
-            observation_to_print.content = truncate_content(
-                observation_to_print.content, self.agent.llm.config.max_message_chars
-            )
         # Use info level if LOG_ALL_EVENTS is set
         log_level = 'info' if os.getenv('LOG_ALL_EVENTS') in ('true', '1') else 'debug'
-        self.log(
-            log_level, str(observation_to_print), extra={'msg_type': 'OBSERVATION'}
-        )
+        # Only format the observation if the message would be emitted
+        if logger.isEnabledFor(logging.INFO if log_level == 'info' else logging.DEBUG):
+            observation_to_print = observation
+            max_message_chars = self.agent.llm.config.max_message_chars
+            if len(observation.content) > max_message_chars:
+                # shallow copy: shares the other fields (e.g. screenshots) with the event
+                observation_to_print = copy.copy(observation)
+                observation_to_print.content = truncate_content(
+                    observation.content, max_message_chars
+                )
+            self.log(
+                log_level, str(observation_to_print), extra={'msg_type': 'OBSERVATION'}
+            )
 
         if observation.llm_metrics is not None:
             self.agent.llm.metrics.merge(observation.llm_metrics)
@@ -843,7 +935,9 @@ class AgentController:
             logger.warning('Stopping agent due to traffic control')
             return
 
-        if self._is_stuck():
+        with trace_span('controller.is_stuck'):
+            is_stuck = self._is_stuck()
+        if is_stuck:
             await self._react_to_exception(
                 AgentStuckInLoopError('Agent got stuck in a loop')
             )
@@ -856,9 +950,14 @@ class AgentController:
             # in replay mode, we don't let the agent to proceed
             # instead, we replay the action from the replay trajectory
             action = self._replay_manager.step()
+        elif self._preflight_context_exceeded():
+            # truncate now instead of sending a request that would overflow
+            self._handle_long_context_error()
+            return
         else:
             try:
-                action = self.agent.step(self.state)
+                with trace_span('agent.step'):
+                    action = self.agent.step(self.state)
                 if action is None:
                     raise LLMNoActionError('No action was returned')
                 action._source = EventSource.AGENT  # type: ignore [attr-defined]
@@ -918,9 +1017,11 @@ class AgentController:
             # Create and log metrics for frontend display
             self._prepare_metrics_for_frontend(action)
 
-            self.event_stream.add_event(action, action._source)  # type: ignore [attr-defined]
+            with trace_span('event_stream.add_event', action=type(action).__name__):
+                self.event_stream.add_event(action, action._source)  # type: ignore [attr-defined]
 
         await self.update_state_after_step()
+        self._maybe_write_history_snapshot()
 
         log_level = 'info' if LOG_ALL_EVENTS else 'debug'
         self.log(log_level, str(action), extra={'msg_type': 'ACTION'})
@@ -1018,6 +1119,19 @@ class AgentController:
                     f'Cleared pending action after {elapsed_time:.2f}s: {action_type} (id={action_id})',
                     extra={'msg_type': 'PENDING_ACTION_CLEARED'},
                 )
+                # Time spent waiting for the runtime to execute the action
+                tracer = get_tracer()
+                if tracer is not None:
+                    end = now_us()
+                    tracer.record(
+                        'runtime.pending_action',
+                        end - elapsed_time * 1_000_000,
+                        end,
+                        session_id=self.id,
+                        step=self.state.iteration,
+                        action=action_type,
+                        action_id=action_id,
+                    )
             self._pending_action_info = None
         else:
             action_id = getattr(action, 'id', 'unknown')
@@ -1083,13 +1197,95 @@ class AgentController:
         # Always load from the event stream to avoid losing history
         self._init_history()
 
+    def _iter_complete_history(self) -> Iterator[Event]:
+        """Streams the complete history (with delegate events) from the event stream."""
+        start_id = self.state.start_id if self.state.start_id >= 0 else 0
+        end_id = (
+            self.state.end_id
+            if self.state.end_id >= 0
+            else self.event_stream.get_latest_event_id()
+        )
+        yield from self.event_stream.search_events(
+            start_id=start_id,
+            end_id=end_id,
+            reverse=False,
+            filter=self.agent_history_filter,
+        )
+
     def get_trajectory(self, include_screenshots: bool = False) -> list[dict]:
         # state history could be partially hidden/truncated before controller is closed
         assert self._closed
-        return [
-            event_to_trajectory(event, include_screenshots)
-            for event in self.state.history
-        ]
+        return list(self.iter_trajectory(include_screenshots))
+
+    def iter_trajectory(
+        self, include_screenshots: bool = False, screenshot_dir: str | None = None
+    ) -> Iterator[dict]:
+        """Yields the trajectory one event at a time.
+
+        If the history was not rebuilt by close(), events are streamed from the event
+        stream. With `screenshot_dir`, screenshots are written there once per content,
+        named by their SHA-256, and replaced by 'sha256:<hex>' references.
+        """
+        assert self._closed
+        events = (
+            self.state.history
+            if self._history_rebuilt
+            else self._iter_complete_history()
+        )
+        for event in events:
+            item = event_to_trajectory(
+                event, include_screenshots or screenshot_dir is not None
+            )
+            if screenshot_dir is not None:
+                self._move_screenshots_to_sidecar(item, screenshot_dir)
+            yield item
+
+    @staticmethod
+    def _move_screenshots_to_sidecar(item: dict, screenshot_dir: str) -> None:
+        extras = item.get('extras')
+        if not isinstance(extras, dict):
+            return
+        for field in TRAJECTORY_SCREENSHOT_FIELDS:
+            value = extras.get(field)
+            if not isinstance(value, str) or not value:
+                continue
+            # data:image/png;base64,<data> -> raw image bytes, otherwise store as is
+            header, _, data = value.partition(',')
+            if header.startswith('data:image/') and header.endswith(';base64') and data:
+                extension = header[len('data:image/') : -len(';base64')]
+                try:
+                    content = base64.b64decode(data)
+                except ValueError:  # binascii.Error: keep the malformed string as is
+                    extension, content = 'txt', value.encode('utf-8')
+            else:
+                extension, content = 'txt', value.encode('utf-8')
+            digest = hashlib.sha256(content).hexdigest()
+            path = os.path.join(screenshot_dir, f'{digest}.{extension}')
+            if not os.path.exists(path):
+                tmp_path = f'{path}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+            extras[field] = f'sha256:{digest}'
+
+    def export_trajectory(
+        self, path: str, screenshot_dir: str | None = None
+    ) -> int:
+        """Streams the trajectory to a JSONL file, one event per line.
+
+        Screenshots go to `screenshot_dir` (default: `<path without extension>_screenshots`),
+        content-addressed by SHA-256, so memory use does not grow with the trajectory.
+        Returns the number of events written.
+        """
+        if screenshot_dir is None:
+            screenshot_dir = f'{os.path.splitext(path)[0]}_screenshots'
+        os.makedirs(screenshot_dir, exist_ok=True)
+        count = 0
+        with open(path, 'w', encoding='utf-8') as f:
+            for item in self.iter_trajectory(screenshot_dir=screenshot_dir):
+                f.write(json.dumps(item, ensure_ascii=False, default=str) + '\n')
+                count += 1
+        return count
 
     def _init_history(self) -> None:
         """Initializes the agent's history from the event stream.
@@ -1120,71 +1316,129 @@ class AgentController:
             self.state.history = []
             return
 
-        events: list[Event] = []
+        # Resume from a snapshot if there is one: only the tail after it is filtered
+        history = self._load_history_snapshot(start_id, end_id)
+        if history is None:
+            events = list(
+                self.event_stream.search_events(
+                    start_id=start_id,
+                    end_id=end_id,
+                    reverse=False,
+                    filter=self.agent_history_filter,
+                )
+            )
+            # Filter out events between delegate action/observation pairs
+            history = self._filter_delegate_events(events)
+        self.state.history = history
+
+        # make sure history is in sync
+        self.state.start_id = start_id
+
+    def _load_history_snapshot(self, start_id: int, end_id: int) -> list[Event] | None:
+        """The snapshotted history plus the filtered tail after it.
+
+        Returns None if snapshots are off, or there is no snapshot matching this history.
+        The snapshotted events are read a cache page at a time, deserializing only
+        those. Delegate ranges are filtered from the first delegation still open in
+        the snapshot on, across the snapshot and the tail.
+        """
+        if not self._snapshot_interval or self.is_delegate:
+            return None
+        snapshot = load_history_snapshot(self.event_stream.file_store, self._snapshot_path)
+        if (
+            snapshot is None
+            or snapshot['start_id'] != start_id
+            or snapshot['last_event_id'] > end_id
+        ):
+            return None
+
+        try:
+            events = load_snapshot_events(self.event_stream, snapshot['history_ids'])
+        except FileNotFoundError:
+            self.log('warning', 'History snapshot refers to missing events, ignoring it.')
+            return None
 
-        # Get rest of history
-        events_to_add = list(
-            self.event_stream.search_events(
-                start_id=start_id,
-                end_id=end_id,
-                reverse=False,
-                filter=self.agent_history_filter,
+        tail: list[Event] = []
+        tail_start = snapshot['last_event_id'] + 1
+        if tail_start <= end_id:
+            tail = list(
+                self.event_stream.search_events(
+                    start_id=tail_start,
+                    end_id=end_id,
+                    reverse=False,
+                    filter=self.agent_history_filter,
+                )
             )
+        self.log(
+            'info',
+            f'Restored {len(events)} history events from snapshot '
+            f'(up to event {snapshot["last_event_id"]}), {len(tail)} from the tail.',
+        )
+        # The delegate ranges before the first open delegation are already filtered
+        open_index = snapshot['open_delegate_index']
+        return events[:open_index] + self._filter_delegate_events(
+            events[open_index:] + tail
         )
-        events.extend(events_to_add)
 
-        # Find all delegate action/observation pairs
-        delegate_ranges: list[tuple[int, int]] = []
-        delegate_action_ids: list[int] = []  # stack of unmatched delegate action IDs
+    def _maybe_write_history_snapshot(self) -> None:
+        """Writes a history snapshot every CONTROLLER_SNAPSHOT_INTERVAL steps."""
+        if not self._snapshot_interval or self.is_delegate:
+            return
+        self._steps_since_snapshot += 1
+        if self._steps_since_snapshot < self._snapshot_interval:
+            return
+        self._steps_since_snapshot = 0
+        write_history_snapshot(
+            self.event_stream.file_store,
+            self._snapshot_path,
+            self.state.history,
+            self.state.start_id,
+        )
+
+    def _filter_delegate_events(self, events: list[Event]) -> list[Event]:
+        """Drops the events between each delegate action and its observation, in one pass.
+
+        The delegate action and observation themselves are kept. Nested delegations are
+        dropped with their enclosing one. An action whose observation is not in `events`
+        (e.g. the delegate is still running) is treated as not delegated, so the events
+        after it are kept, except for nested delegations that did finish.
+        """
+        result: list[Event] = []
+        # stack of open delegate actions, each with the events seen since it
+        open_delegates: list[tuple[AgentDelegateAction, list[Event]]] = []
 
         for event in events:
             if isinstance(event, AgentDelegateAction):
-                delegate_action_ids.append(event.id)
                 # Note: we can get agent=event.agent and task=event.inputs.get('task','')
                 # if we need to track these in the future
+                open_delegates.append((event, []))
+                continue
 
-            elif isinstance(event, AgentDelegateObservation):
+            if isinstance(event, AgentDelegateObservation):
                 # Match with most recent unmatched delegate action
-                if not delegate_action_ids:
+                if not open_delegates:
                     self.log(
                         'warning',
                         f'Found AgentDelegateObservation without matching action at id={event.id}',
                     )
+                else:
+                    # The delegate's events are dropped, its action and observation kept
+                    action, _ = open_delegates.pop()
+                    target = open_delegates[-1][1] if open_delegates else result
+                    target.append(action)
+                    target.append(event)
                     continue
 
-                action_id = delegate_action_ids.pop()
-                delegate_ranges.append((action_id, event.id))
-
-        # Filter out events between delegate action/observation pairs
-        if delegate_ranges:
-            filtered_events: list[Event] = []
-            current_idx = 0
-
-            for start_id, end_id in sorted(delegate_ranges):
-                # Add events before delegate range
-                filtered_events.extend(
-                    event for event in events[current_idx:] if event.id < start_id
-                )
-
-                # Add delegate action and observation
-                filtered_events.extend(
-                    event for event in events if event.id in (start_id, end_id)
-                )
-
-                # Update index to after delegate range
-                current_idx = next(
-                    (i for i, e in enumerate(events) if e.id > end_id), len(events)
-                )
+            (open_delegates[-1][1] if open_delegates else result).append(event)
 
-            # Add any remaining events after last delegate range
-            filtered_events.extend(events[current_idx:])
+        # Unmatched delegate actions: keep them and the events after them
+        while open_delegates:
+            action, pending = open_delegates.pop()
+            target = open_delegates[-1][1] if open_delegates else result
+            target.append(action)
+            target.extend(pending)
 
-            self.state.history = filtered_events
-        else:
-            self.state.history = events
-
-        # make sure history is in sync
-        self.state.start_id = start_id
+        return result
 
     def _handle_long_context_error(self) -> None:
         # When context window is exceeded, keep roughly half of agent interactions
@@ -1230,11 +1484,14 @@ class AgentController:
 
         It preserves action-observation pairs and ensures that the system message,
         the first user message, and its associated recall observation are always included
-        at the beginning of the context window.
+        at the beginning of the context window. The essential events are looked up in
+        the incremental history index, so only the kept events are visited.
 
         The algorithm:
         1. Identify essential initial events: System Message, First User Message, Recall Observation.
-        2. Determine the slice of recent events to potentially keep.
+        2. Determine the slice of recent events to potentially keep: roughly half of them,
+           or in 'token_budget' mode (HISTORY_TRUNCATION_MODE) the newest ones fitting
+           the token budget.
         3. Validate the start of the recent slice for dangling observations.
         4. Combine essential events and validated recent events, ensuring essentials come first.
 
@@ -1248,6 +1505,9 @@ class AgentController:
             return []
 
         history = self.state.history
+        # Catch up with the history (rebuilds the index only if history was replaced)
+        index = self._history_index
+        index.sync(history)
 
         # 1. Identify essential initial events
         system_message: SystemMessageAction | None = None
@@ -1255,10 +1515,9 @@ class AgentController:
         recall_action: RecallAction | None = None
         recall_observation: Observation | None = None
 
-        # Find System Message (should be the first event, if it exists)
-        system_message = next(
-            (e for e in history if isinstance(e, SystemMessageAction)), None
-        )
+        # System Message (should be the first event, if it exists)
+        if index.system_message_index is not None:
+            system_message = history[index.system_message_index]  # type: ignore[assignment]
         assert (
             system_message is None
             or isinstance(system_message, SystemMessageAction)
@@ -1270,34 +1529,17 @@ class AgentController:
         if first_user_msg is None:
             raise RuntimeError('No first user message found in the event stream.')
 
-        first_user_msg_index = -1
-        for i, event in enumerate(history):
-            if isinstance(event, MessageAction) and event.source == EventSource.USER:
-                first_user_msg = event
-                first_user_msg_index = i
-                break
+        if index.first_user_message_index is not None:
+            first_user_msg = history[index.first_user_message_index]  # type: ignore[assignment]
 
-        # Find Recall Action and Observation related to the First User Message
-        if first_user_msg is not None and first_user_msg_index != -1:
-            # Look for RecallAction after the first user message
-            for i in range(first_user_msg_index + 1, len(history)):
-                event = history[i]
-                if (
-                    isinstance(event, RecallAction)
-                    and event.query == first_user_msg.content
-                ):
-                    # Found RecallAction, now look for its Observation
-                    recall_action = event
-                    for j in range(i + 1, len(history)):
-                        obs_event = history[j]
-                        # Check for Observation caused by this RecallAction
-                        if (
-                            isinstance(obs_event, Observation)
-                            and obs_event.cause == recall_action.id
-                        ):
-                            recall_observation = obs_event
-                            break  # Found the observation, stop inner loop
-                    break  # Found the recall action (and maybe obs), stop outer loop
+            # Recall Action and Observation related to the First User Message
+            if index.recall_action_index is not None:
+                recall_action = history[index.recall_action_index]  # type: ignore[assignment]
+                recall_observation_index = index.observation_index_for(
+                    index.recall_action_index
+                )
+                if recall_observation_index is not None:
+                    recall_observation = history[recall_observation_index]  # type: ignore[assignment]
 
         essential_events: list[Event] = []
         if system_message:
@@ -1311,13 +1553,9 @@ class AgentController:
             essential_events.append(recall_observation)
 
         # 2. Determine the slice of recent events to potentially keep
-        num_non_essential_events = len(history) - len(essential_events)
-        # Keep roughly half of the non-essential events, minimum 1
-        num_recent_to_keep = max(1, num_non_essential_events // 2)
-
-        # Calculate the starting index for the recent slice
-        slice_start_index = len(history) - num_recent_to_keep
-        slice_start_index = max(0, slice_start_index)  # Ensure index is not negative
+        slice_start_index = self._token_budget_slice_start(essential_events)
+        if slice_start_index is None:
+            slice_start_index = self._halve_slice_start(essential_events)
         recent_events_slice = history[slice_start_index:]
 
         # 3. Validate the start of the recent slice for dangling observations
@@ -1352,6 +1590,99 @@ class AgentController:
 
         return events_to_keep
 
+    def _preflight_context_exceeded(self) -> bool:
+        """Whether the estimated history is too large for the LLM's context window.
+
+        Uses the token estimates cached in the history index, minus the events forgotten
+        by condensations. Skipped while the agent still has pending actions, since that
+        step does not call the LLM. Avoided overflows are counted in state.extra_data.
+        """
+        if not (
+            self._preflight_context_check and self.agent.config.enable_history_truncation
+        ):
+            return False
+        # The agent answers from actions it already queued, without calling the LLM
+        if getattr(self.agent, 'pending_actions', None):
+            return False
+        max_input_tokens = self.agent.llm.config.max_input_tokens
+        if not max_input_tokens:
+            return False
+
+        self._history_index.sync(self.state.history)
+        estimate = self._history_index.visible_tokens
+        if estimate <= max_input_tokens * self._preflight_context_threshold:
+            self._last_preflight_estimate = None
+            return False
+        # The last truncation did not shrink the history: let the LLM call decide
+        if (
+            self._last_preflight_estimate is not None
+            and estimate >= self._last_preflight_estimate
+        ):
+            return False
+
+        self._last_preflight_estimate = estimate
+        self.state.extra_data['preflight_truncations'] = (
+            self.state.extra_data.get('preflight_truncations', 0) + 1
+        )
+        self.log(
+            'info',
+            f'Estimated history of ~{estimate} tokens exceeds '
+            f'{self._preflight_context_threshold:.0%} of max_input_tokens ({max_input_tokens}). '
+            'Truncating before calling the LLM.',
+        )
+        return True
+
+    def _halve_slice_start(self, essential_events: list[Event]) -> int:
+        """Start index of the newest half of the non-essential events ('halve' mode)."""
+        num_non_essential_events = len(self.state.history) - len(essential_events)
+        # Keep roughly half of the non-essential events, minimum 1
+        num_recent_to_keep = max(1, num_non_essential_events // 2)
+
+        # Calculate the starting index for the recent slice
+        slice_start_index = len(self.state.history) - num_recent_to_keep
+        return max(0, slice_start_index)  # Ensure index is not negative
+
+    def _token_budget_slice_start(self, essential_events: list[Event]) -> int | None:
+        """Start index of the newest events fitting the token budget, in 'token_budget' mode.
+
+        The budget is HISTORY_TRUNCATION_TARGET_FRACTION of the LLM's max_input_tokens,
+        minus the essential events. Returns None (halve instead) in 'halve' mode, if
+        the context window size is unknown, or if every event fits the budget: the
+        estimate can be low (images, unusual text), and a truncation after an
+        overflow must drop something.
+        """
+        if self._history_truncation_mode != HISTORY_TRUNCATION_TOKEN_BUDGET:
+            return None
+        max_input_tokens = self.agent.llm.config.max_input_tokens
+        if not max_input_tokens:
+            return None
+
+        index = self._history_index
+        index.update_token_estimates()
+        essential_positions = frozenset(
+            index.id_to_index[e.id] for e in essential_events if e.id in index.id_to_index
+        )
+        budget = int(max_input_tokens * self._history_truncation_target_fraction) - sum(
+            index.token_estimates[i] for i in essential_positions
+        )
+        # Never drop into the essential prefix: the essentials are kept separately
+        stop = max(essential_positions, default=-1) + 1
+        slice_start_index = index.newest_start_within(
+            max(budget, 0), stop=stop, skip=essential_positions
+        )
+        if slice_start_index <= stop:
+            self.log(
+                'debug',
+                f'Token-budget truncation would keep every event within ~{budget} tokens; halving instead.',
+            )
+            return None
+        self.log(
+            'debug',
+            f'Token-budget truncation: keeping events from index {slice_start_index} '
+            f'within ~{budget} tokens.',
+        )
+        return slice_start_index
+
     def _is_stuck(self) -> bool:
         """Checks if the agent or its delegate is stuck in a loop.
 
@@ -1362,6 +1693,10 @@ class AgentController:
         if self.delegate and self.delegate._is_stuck():
             return True
 
+        # the rolling fingerprints rule out a loop without re-examining the history
+        self._loop_fingerprints.sync(self.state.history)
+        if not self._loop_fingerprints.may_be_stuck():
+            return False
         return self._stuck_detector.is_stuck(self.headless_mode)
 
     def _prepare_metrics_for_frontend(self, action: Action) -> None:
@@ -1371,6 +1706,9 @@ class AgentController:
         - accumulated_cost: The current total cost
         - accumulated_token_usage: Accumulated token statistics across all API calls
 
+        The snapshot is rebuilt only when an LLM call was recorded since the last
+        action; otherwise the previous (immutable) snapshot is attached again.
+
         This includes metrics from both the agent's LLM and the condenser's LLM if it exists.
 
         Args:
@@ -1380,41 +1718,57 @@ class AgentController:
         agent_metrics = self.agent.llm.metrics
 
         # Get metrics from condenser LLM if it exists
-        condenser_metrics: TokenUsage | None = None
+        condenser_metrics: Metrics | None = None
         if hasattr(self.agent, 'condenser') and hasattr(self.agent.condenser, 'llm'):
             condenser_metrics = self.agent.condenser.llm.metrics
 
-        # Create a new minimal metrics object with just what the frontend needs
-        metrics = Metrics(model_name=agent_metrics.model_name)
-
-        # Set accumulated cost (sum of agent and condenser costs)
-        metrics.accumulated_cost = agent_metrics.accumulated_cost
-        if condenser_metrics:
-            metrics.accumulated_cost += condenser_metrics.accumulated_cost
-
-        # Set accumulated token usage (sum of agent and condenser token usage)
-        # Use a deep copy to ensure we don't modify the original object
-        metrics._accumulated_token_usage = (
-            agent_metrics.accumulated_token_usage.model_copy(deep=True)
+        # Totals only change when an LLM call was recorded: reuse the previous snapshot
+        snapshot_key = (
+            id(agent_metrics),
+            agent_metrics.accumulated_cost,
+            len(agent_metrics.token_usages),
+            id(condenser_metrics),
+            condenser_metrics.accumulated_cost if condenser_metrics else 0.0,
+            len(condenser_metrics.token_usages) if condenser_metrics else 0,
         )
-        if condenser_metrics:
-            metrics._accumulated_token_usage = (
-                metrics._accumulated_token_usage
-                + condenser_metrics.accumulated_token_usage
-            )
+        if self._metrics_snapshot is None or self._metrics_snapshot[0] != snapshot_key:
+            # Create a new minimal metrics object with just what the frontend needs
+            metrics = Metrics(model_name=agent_metrics.model_name)
+
+            # Set accumulated cost (sum of agent and condenser costs)
+            metrics.accumulated_cost = agent_metrics.accumulated_cost
+            if condenser_metrics:
+                metrics.accumulated_cost += condenser_metrics.accumulated_cost
+
+            # Set accumulated token usage (sum of agent and condenser token usage).
+            # TokenUsage holds only scalars, so a shallow copy (or the new object
+            # returned by +) is enough not to share state with the LLM's metrics
+            if condenser_metrics:
+                metrics._accumulated_token_usage = (
+                    agent_metrics.accumulated_token_usage
+                    + condenser_metrics.accumulated_token_usage
+                )
+            else:
+                metrics._accumulated_token_usage = (
+                    agent_metrics.accumulated_token_usage.model_copy()
+                )
+            self._metrics_snapshot = (snapshot_key, metrics)
 
-        action.llm_metrics = metrics
+        # The snapshot is shared by all actions until the totals change; never mutate it
+        action.llm_metrics = self._metrics_snapshot[1]
 
         # Log the metrics information for debugging
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         # Get the latest usage directly from the agent's metrics
         latest_usage = None
-        if self.agent.llm.metrics.token_usages:
-            latest_usage = self.agent.llm.metrics.token_usages[-1]
+        if agent_metrics.token_usages:
+            latest_usage = agent_metrics.token_usages[-1]
 
-        accumulated_usage = self.agent.llm.metrics.accumulated_token_usage
+        accumulated_usage = agent_metrics.accumulated_token_usage
         self.log(
             'debug',
-            f'Action metrics - accumulated_cost: {metrics.accumulated_cost}, '
+            f'Action metrics - accumulated_cost: {action.llm_metrics.accumulated_cost}, '
             f'latest tokens (prompt/completion/cache_read/cache_write): '
             f'{latest_usage.prompt_tokens if latest_usage else 0}/'
             f'{latest_usage.completion_tokens if latest_usage else 0}/'
@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+from openhands.controller.token_estimate import estimate_tokens
+from openhands.events import EventSource
+from openhands.events.action import MessageAction, SystemMessageAction
+from openhands.events.action.agent import CondensationAction, RecallAction
+from openhands.events.event import Event
+from openhands.events.observation import Observation
+
+# Per-message overhead (role, separators) added to every event's estimate
+EVENT_TOKEN_OVERHEAD = 4
+# Rough cost of one image sent to a vision model
+IMAGE_TOKEN_ESTIMATE = 1000
+
+
+def estimate_event_tokens(event: Event) -> int:
+    """Rough token count of an event as the LLM will see it.
+
+    Text is counted like local memories (~4 ASCII characters or 1 CJK character per
+    token), plus IMAGE_TOKEN_ESTIMATE per attached image or screenshot.
+    """
+    try:
+        text = str(event)
+    except Exception:
+        text = ''
+    images = len(getattr(event, 'image_urls', None) or [])
+    if getattr(event, 'screenshot', None):
+        images += 1
+    return estimate_tokens(text) + images * IMAGE_TOKEN_ESTIMATE + EVENT_TOKEN_OVERHEAD
+
+
+class HistoryIndex:
+    """Incremental index over `State.history` for the conversation window.
+
+    Records where the essential events are (system message, first user message,
+    and the RecallAction/observation pair for that message), which observation
+    answers each action (by `cause`) and the position of every event id. Token
+    estimates are only computed when asked for (token-budget truncation or the
+    preflight check), once per event: `visible_tokens` is a running estimate of
+    the tokens the agent will send, i.e. all events minus those forgotten by
+    CondensationActions. The controller updates it as events are appended, so
+    applying the conversation window does not have to re-scan the whole history.
+
+    The index is tied to one history list. `sync` rebuilds it if the list was
+    replaced or modified other than by appending (e.g. in `_init_history` or
+    `close`).
+    """
+
+    def __init__(self) -> None:
+        self._history: list[Event] | None = None
+        self._length = 0
+        self._last_id: int | None = None
+        self.id_to_index: dict[int, int] = {}
+        self.token_estimates: list[int] = []
+        self.total_tokens = 0
+        self.forgotten_tokens = 0
+        self._forgotten_ids: set[int] = set()
+        self.observation_index_by_cause: dict[int, int] = {}
+        self.system_message_index: int | None = None
+        self.first_user_message_index: int | None = None
+        self.recall_action_index: int | None = None
+
+    def __len__(self) -> int:
+        return self._length
+
+    def _reset(self, history: list[Event]) -> None:
+        self.__init__()  # type: ignore[misc]
+        self._history = history
+
+    def _add(self, event: Event) -> None:
+        index = self._length
+        self._length += 1
+        self.id_to_index[event.id] = index
+        self._last_id = event.id
+
+        if isinstance(event, SystemMessageAction):
+            if self.system_message_index is None:
+                self.system_message_index = index
+        elif isinstance(event, MessageAction) and event.source == EventSource.USER:
+            if self.first_user_message_index is None:
+                self.first_user_message_index = index
+        elif isinstance(event, RecallAction):
+            # The recall triggered by the first user message (same query)
+            if (
+                self.recall_action_index is None
+                and self.first_user_message_index is not None
+                and self._history is not None
+                and event.query
+                == self._history[self.first_user_message_index].content  # type: ignore[attr-defined]
+            ):
+                self.recall_action_index = index
+        elif isinstance(event, Observation) and event.cause is not None:
+            # Keep the first observation for each action
+            self.observation_index_by_cause.setdefault(event.cause, index)
+        elif isinstance(event, CondensationAction):
+            self._forget(event)
+
+    def _forget(self, condensation: CondensationAction) -> None:
+        try:
+            forgotten = condensation.forgotten
+        except (AssertionError, TypeError):
+            return
+        for event_id in forgotten:
+            position = self.id_to_index.get(event_id)
+            if position is not None and event_id not in self._forgotten_ids:
+                self._forgotten_ids.add(event_id)
+                # not estimated yet: counted when it is
+                if position < len(self.token_estimates):
+                    self.forgotten_tokens += self.token_estimates[position]
+
+    def update_token_estimates(self) -> None:
+        """Computes the token estimates of the events indexed since the last call."""
+        assert self._history is not None or self._length == 0
+        for position in range(len(self.token_estimates), self._length):
+            event = self._history[position]  # type: ignore[index]
+            tokens = estimate_event_tokens(event)
+            self.token_estimates.append(tokens)
+            self.total_tokens += tokens
+            if event.id in self._forgotten_ids:
+                self.forgotten_tokens += tokens
+
+    @property
+    def visible_tokens(self) -> int:
+        """Estimated tokens of the events not forgotten by a condensation."""
+        self.update_token_estimates()
+        return self.total_tokens - self.forgotten_tokens
+
+    def _in_sync(self, history: list[Event]) -> bool:
+        if history is not self._history or len(history) < len(self):
+            return False
+        return len(self) == 0 or history[len(self) - 1].id == self._last_id
+
+    def sync(self, history: list[Event]) -> None:
+        """Indexes the events appended to `history` since the last call (rebuilding if needed)."""
+        if not self._in_sync(history):
+            self._reset(history)
+        for event in history[len(self) :]:
+            self._add(event)
+
+    def observation_index_for(self, action_index: int) -> int | None:
+        """Position of the observation caused by the action at `action_index`, if any."""
+        assert self._history is not None
+        return self.observation_index_by_cause.get(self._history[action_index].id)
+
+    def newest_start_within(
+        self, budget: int, stop: int = 0, skip: frozenset[int] = frozenset()
+    ) -> int:
+        """Start of the longest suffix of the history (after `stop`) whose estimates fit `budget`.
+
+        Positions in `skip` (essential events kept anyway) are not counted. At
+        least the last event is always included.
+        """
+        self.update_token_estimates()
+        start = self._length
+        used = 0
+        while start > stop:
+            cost = 0 if start - 1 in skip else self.token_estimates[start - 1]
+            if used + cost > budget and start < self._length:
+                break
+            used += cost
+            start -= 1
+        return start
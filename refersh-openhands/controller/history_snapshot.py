@@ -0,0 +1,99 @@
+"""Compact snapshots of the controller's history, for fast session resume.
+
+A snapshot records the ids of the events in `State.history` (after filtering
+and delegate-range removal), the last event id it covers, and where the first
+delegation still open at that time starts. On resume the controller reads the
+snapshotted events through the event store's cache pages (one file per page
+instead of one per event) and deserializes only those events, skipping the
+ones the history leaves out (hidden, filtered and delegate events). Only the
+tail of the event stream after the snapshot is searched and filtered, and
+delegate ranges are re-filtered only from the first open delegation on.
+
+Snapshots are written next to the conversation's events in the event stream's
+file store, every CONTROLLER_SNAPSHOT_INTERVAL steps (0, the default, disables them).
+"""
+
+from __future__ import annotations
+
+import json
+
+from openhands.core.logger import openhands_logger as logger
+from openhands.events.action import AgentDelegateAction
+from openhands.events.event import Event
+from openhands.events.event_store import EventStore
+from openhands.events.observation import AgentDelegateObservation
+from openhands.storage.files import FileStore
+from openhands.storage.locations import get_conversation_dir
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_FILENAME = 'controller_history_snapshot.json'
+
+
+def get_snapshot_path(sid: str, user_id: str | None = None) -> str:
+    return f'{get_conversation_dir(sid, user_id)}{SNAPSHOT_FILENAME}'
+
+
+def open_delegate_index(history: list[Event]) -> int:
+    """Position of the first delegate action without an observation (len(history) if none)."""
+    open_positions: list[int] = []
+    for position, event in enumerate(history):
+        if isinstance(event, AgentDelegateAction):
+            open_positions.append(position)
+        elif isinstance(event, AgentDelegateObservation) and open_positions:
+            open_positions.pop()
+    return open_positions[0] if open_positions else len(history)
+
+
+def write_history_snapshot(
+    file_store: FileStore,
+    path: str,
+    history: list[Event],
+    start_id: int,
+) -> None:
+    """Writes the ids of `history`. The snapshot covers events up to the highest id.
+
+    History is not always in id order, so the highest id, not the last event's,
+    is where the tail starts on restore.
+    """
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'start_id': start_id,
+        'last_event_id': max((event.id for event in history), default=start_id - 1),
+        'open_delegate_index': open_delegate_index(history),
+        'history_ids': [event.id for event in history],
+    }
+    try:
+        file_store.write(path, json.dumps(snapshot, separators=(',', ':')))
+    except Exception as e:
+        logger.warning(f'Could not write controller history snapshot {path}: {e}')
+
+
+def load_snapshot_events(event_store: EventStore, event_ids: list[int]) -> list[Event]:
+    """The events with the given ids, in that order.
+
+    Reads them a cache page at a time, like search_events, but only deserializes
+    the requested events. Events in pages that are not cached yet are read one by
+    one. Raises FileNotFoundError if an event is missing.
+    """
+    events: dict[int, Event] = {}
+    page = None
+    for event_id in sorted(set(event_ids)):
+        if page is None or not page.covers(event_id):
+            page = event_store._load_cache_page_for_index(event_id)
+        event = page.get_event(event_id)
+        events[event_id] = event if event is not None else event_store.get_event(event_id)
+    return [events[event_id] for event_id in event_ids]
+
+
+def load_history_snapshot(file_store: FileStore, path: str) -> dict | None:
+    """Reads a snapshot, or returns None if there is no usable one."""
+    try:
+        snapshot = json.loads(file_store.read(path))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f'Ignoring unreadable controller history snapshot {path}: {e}')
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    return snapshot
@@ -1,30 +1,445 @@
 # openhands/controller/local_memory.py
-import json
+import asyncio
+import functools
+import math
 import os
+import re
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from openhands.controller.local_memory_store import (
+    FSYNC_ALWAYS,
+    JsonlJournalMemoryStore,
+    JsonMemoryStore,
+    SqliteMemoryStore,
+    compress_entry,
+    entry_content,
+    stored_size,
+)
+from openhands.controller.token_estimate import estimate_tokens
+
+# 存储后端: 'json' (单个 JSON 字典, 默认), 'jsonl' (追加写入的日志文件)
+# 或 'sqlite' (所有任务共用一个数据库, 按 scope 区分, 支持 FTS5 全文检索)
+STORAGE_JSON = 'json'
+STORAGE_JSONL = 'jsonl'
+STORAGE_SQLITE = 'sqlite'
+MEMORY_FILE_EXTENSIONS = {
+    STORAGE_JSON: '.json',
+    STORAGE_JSONL: '.jsonl',
+    STORAGE_SQLITE: '.sqlite3',
+}
+DEFAULT_MEMORY_FILE_STEM = 'task_local_memory'
+# sqlite 后端中, 未指定 namespace 时使用的 scope, 以及共享层的默认 scope
+DEFAULT_SQLITE_SCOPE = 'default'
+DEFAULT_SHARED_SQLITE_SCOPE = 'shared'
+# 按会话/任务分片时, 各分片文件所在的根目录
+DEFAULT_MEMORY_ROOT = 'task_local_memory'
+
+
+# 容量限制与淘汰: 0 表示不限制. 超出上限时按最近召回时间 (LRU) 淘汰,
+# 设置 TTL 后, 超过 TTL 未被保存或召回的记忆会在下次保存时过期删除
+DEFAULT_MAX_ENTRIES = 0
+DEFAULT_MAX_BYTES = 0
+DEFAULT_TTL_SECONDS = 0
+# 召回统计 (LRU 时钟) 只在设置了上限或 TTL 时记录, 先保存在内存中,
+# 累计到这么多条、下次保存或关闭时才批量写入, 召回本身不写文件
+RECALL_STATS_FLUSH_BATCH = 32
+# 超过该字节数的内容压缩存储 (zstd, 未安装时用 zlib). 默认 0, 不压缩:
+# 压缩会改变记忆文件的格式, 需要显式开启
+DEFAULT_COMPRESS_THRESHOLD = 0
+
+
+def _env_number(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def last_used(entry: dict) -> float:
+    """When an entry was last saved or recalled (the LRU / TTL clock)."""
+    return max(entry.get('last_recalled') or 0, entry.get('timestamp') or 0)
+
+
+# 关键词检索: 标题中的词权重更高, 默认返回前 k 条
+TITLE_TERM_WEIGHT = 3
+DEFAULT_SEARCH_TOP_K = 5
+SNIPPET_CHARS = 160
+# 大纲中最多列出的共享记忆标题数
+SHARED_OUTLINE_MAX_TITLES = 50
+
+
+def tokenize(text: str) -> list[str]:
+    """Lower-cased search terms: ASCII words/numbers (plus their CamelCase parts) and single CJK characters."""
+    terms = []
+    for word in re.findall(r'[A-Za-z0-9]+|[\u4e00-\u9fff]', text):
+        terms.append(word.lower())
+        parts = re.findall(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+', word)
+        if len(parts) > 1:
+            parts = [part.lower() for part in parts]
+            terms.extend(parts)
+            # Adjacent pairs too, so 'gitlab' matches the title 'GitLabCredentials'
+            terms.extend(a + b for a, b in zip(parts, parts[1:]))
+    return terms
+
+
+class MemoryIndex:
+    """Inverted index over memory titles and content.
+
+    Entries are indexed once when first seen (or when their timestamp changes),
+    so a search only tokenizes the query and entries added since the last one.
+    """
+
+    def __init__(self):
+        self.postings: dict[str, dict[str, int]] = {}  # term -> {title: weighted tf}
+        self.indexed: dict[str, tuple] = {}  # title -> (timestamp, terms)
+
+    def add(self, title: str, entry: dict) -> None:
+        if title in self.indexed:
+            self.remove(title)
+        counts = Counter(tokenize(entry_content(entry)))
+        for term in tokenize(title):
+            counts[term] += TITLE_TERM_WEIGHT
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[title] = count
+        self.indexed[title] = (entry.get('timestamp'), tuple(counts))
+
+    def remove(self, title: str) -> None:
+        _, terms = self.indexed.pop(title)
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(title, None)
+                if not postings:
+                    del self.postings[term]
+
+    def sync(self, memories: dict) -> None:
+        """Brings the index in line with the current memories (e.g. after another process wrote)."""
+        for title in [t for t in self.indexed if t not in memories]:
+            self.remove(title)
+        for title, entry in memories.items():
+            indexed = self.indexed.get(title)
+            if indexed is None or indexed[0] != entry.get('timestamp'):
+                self.add(title, entry)
+
+    def search(self, query: str) -> list[tuple[str, float]]:
+        """Returns [(title, score)] for entries matching any query term, best first."""
+        total = max(len(self.indexed), 1)
+        scores: Counter = Counter()
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + total / len(postings))
+            for title, count in postings.items():
+                scores[title] += idf * (1 + math.log(count))
+        return scores.most_common()
+
+
+# 分块召回: 超过 DEFAULT_RECALL_MAX_CHARS 的记忆默认只返回第一块
+CHUNK_CHARS = 4000
+DEFAULT_RECALL_MAX_CHARS = 8000
+
+
+def compute_chunk_starts(content: str, chunk_chars: int = CHUNK_CHARS) -> list[int]:
+    """Character offsets where chunks start, preferring to break after a newline or space."""
+    starts = [0]
+    while len(content) - starts[-1] > chunk_chars:
+        start = starts[-1]
+        limit = start + chunk_chars
+        # Break in the second half of the window if a natural boundary exists
+        cut = content.rfind('\n', start + chunk_chars // 2, limit)
+        if cut < 0:
+            cut = content.rfind(' ', start + chunk_chars // 2, limit)
+        starts.append(cut + 1 if cut >= 0 else limit)
+    return starts
+
+
+# 旧版本记忆的大小信息缓存 (按内容), 不写回存储返回的条目
+LEGACY_SIZE_CACHE_ENTRIES = 4096
+
+
+@functools.lru_cache(maxsize=LEGACY_SIZE_CACHE_ENTRIES)
+def _content_size(content: str) -> tuple[int, int, int]:
+    """(size in bytes, token estimate, number of chunks) of a memory's content."""
+    return (
+        len(content.encode('utf-8')),
+        estimate_tokens(content),
+        len(compute_chunk_starts(content)),
+    )
+
+
+def describe_size(entry: dict) -> str:
+    """e.g. '12.3 KB, ~3100 tokens, 4 chunks' for the outline."""
+    size_bytes = entry.get('size_bytes')
+    token_estimate = entry.get('token_estimate')
+    chunks = entry.get('chunks')
+    if size_bytes is None or token_estimate is None or chunks is None:
+        # 旧版本保存的记忆没有大小信息: 按内容计算一次并缓存.
+        # 存储返回的条目是共享的, 不能修改
+        size_bytes, token_estimate, num_chunks = _content_size(entry_content(entry))
+    else:
+        num_chunks = len(chunks)
+    size = f'{size_bytes} B' if size_bytes < 1024 else f'{size_bytes / 1024:.1f} KB'
+    chunk_info = f', {num_chunks} chunks' if num_chunks > 1 else ''
+    return f'{size}, ~{token_estimate} tokens{chunk_info}'
+
+
+def make_snippet(content: str, query: str) -> str:
+    """A short excerpt of `content` around the first occurrence of a query term."""
+    lowered = content.lower()
+    positions = [lowered.find(term) for term in tokenize(query)]
+    positions = [p for p in positions if p >= 0]
+    start = max(0, min(positions) - SNIPPET_CHARS // 4) if positions else 0
+    snippet = content[start : start + SNIPPET_CHARS].replace('\n', ' ')
+    prefix = '...' if start > 0 else ''
+    suffix = '...' if start + SNIPPET_CHARS < len(content) else ''
+    return f'{prefix}{snippet}{suffix}'
+
+
+def _storage_of(filepath: str) -> str:
+    """Guesses the storage of an existing memory file from its extension."""
+    if filepath.endswith(('.sqlite3', '.sqlite', '.db')):
+        return STORAGE_SQLITE
+    if filepath.endswith('.jsonl'):
+        return STORAGE_JSONL
+    return STORAGE_JSON
+
+
+def _make_store(
+    storage: str,
+    filepath: str,
+    fsync_policy: str | None = None,
+    scope: str = DEFAULT_SQLITE_SCOPE,
+):
+    if storage == STORAGE_SQLITE:
+        return SqliteMemoryStore(filepath, scope=scope)
+    if storage == STORAGE_JSONL:
+        return JsonlJournalMemoryStore(
+            filepath,
+            fsync_policy=fsync_policy or os.getenv('LOCAL_MEMORY_FSYNC', FSYNC_ALWAYS),
+        )
+    return JsonMemoryStore(filepath)
+
+
+# 每个记忆文件一个单线程执行器: 文件 I/O 不阻塞事件循环, 且同一文件的保存按提交顺序执行.
+# 按引用计数共享, 最后一个使用它的 handler 关闭时释放线程 (每个会话一个文件, 否则线程会泄漏)
+_EXECUTORS: dict[str, tuple[ThreadPoolExecutor, int]] = {}
+_EXECUTORS_LOCK = threading.Lock()
+
+
+def _acquire_executor(memory_file: str) -> ThreadPoolExecutor:
+    """Returns the single-worker executor of a memory file, shared by all its handlers."""
+    key = os.path.abspath(memory_file)
+    with _EXECUTORS_LOCK:
+        executor, refs = _EXECUTORS.get(key, (None, 0))
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='local-memory'
+            )
+        _EXECUTORS[key] = (executor, refs + 1)
+        return executor
+
+
+def _release_executor(memory_file: str) -> None:
+    """Drops a handler's reference; the last one shuts the executor down after its queued work."""
+    key = os.path.abspath(memory_file)
+    with _EXECUTORS_LOCK:
+        executor, refs = _EXECUTORS.get(key, (None, 0))
+        if executor is None:
+            return
+        if refs > 1:
+            _EXECUTORS[key] = (executor, refs - 1)
+            return
+        del _EXECUTORS[key]
+    executor.shutdown(wait=False)
 
 
 class LocalMemoryHandler:
 
-    def __init__(self, filepath: str = "task_local_memory.json"):
-        self.memory_file = filepath
+    def __init__(
+        self,
+        filepath: str | None = None,
+        storage: str | None = None,
+        fsync_policy: str | None = None,
+        namespace: str | None = None,
+        root: str | None = None,
+        shared_filepath: str | None = None,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+        ttl_seconds: float | None = None,
+        compress_threshold: int | None = None,
+    ):
+        """
+        Args:
+            filepath: Explicit path of the memory file. Overrides namespace/root.
+            storage: 'json', 'jsonl' or 'sqlite'. Defaults to $LOCAL_MEMORY_STORAGE or 'json'.
+            fsync_policy: fsync policy of the 'jsonl' storage ('always', 'interval'
+                or 'never'). Defaults to $LOCAL_MEMORY_FSYNC or 'always'.
+            namespace: Session id or task name. Each namespace gets its own file
+                `<root>/<namespace>.json(l)`, so parallel runs don't share a file.
+                Without a namespace (and filepath), the legacy
+                task_local_memory.json(l) in the working directory is used.
+                With 'sqlite', all namespaces share `<root>/task_local_memory.sqlite3`
+                and the namespace is the scope of the entries.
+            root: Directory of the namespaced files. Defaults to
+                $LOCAL_MEMORY_ROOT or ./task_local_memory.
+            shared_filepath: Optional read-only memory file with cross-task
+                knowledge. Its entries are recalled when no local entry has the
+                title. Defaults to $LOCAL_MEMORY_SHARED_FILE. A SQLite database
+                is read in the scope $LOCAL_MEMORY_SHARED_SCOPE or 'shared'.
+            max_entries: Maximum number of entries; the least recently recalled
+                ones are evicted on save. Defaults to $LOCAL_MEMORY_MAX_ENTRIES,
+                0 (unlimited).
+            max_bytes: Maximum stored size of all entries, enforced the same way.
+                Defaults to $LOCAL_MEMORY_MAX_BYTES, 0 (unlimited).
+            ttl_seconds: Entries neither saved nor recalled for this long expire
+                on the next save. Defaults to $LOCAL_MEMORY_TTL_SECONDS, 0 (never).
+            compress_threshold: Contents of at least this many bytes are stored
+                compressed. Defaults to $LOCAL_MEMORY_COMPRESS_THRESHOLD or 0,
+                which disables compression (the file format stays unchanged).
+        """
+        storage = storage or os.getenv('LOCAL_MEMORY_STORAGE', STORAGE_JSON)
+        if storage not in MEMORY_FILE_EXTENSIONS:
+            raise ValueError(
+                f'Unknown local memory storage: {storage}. Expected one of {list(MEMORY_FILE_EXTENSIONS)}'
+            )
+        extension = MEMORY_FILE_EXTENSIONS[storage]
+
+        if filepath is None and namespace:
+            root = root or os.getenv('LOCAL_MEMORY_ROOT', DEFAULT_MEMORY_ROOT)
+            os.makedirs(root, exist_ok=True)
+            if storage == STORAGE_SQLITE:
+                # 所有任务共用一个数据库, namespace 作为 scope
+                filepath = os.path.join(root, DEFAULT_MEMORY_FILE_STEM + extension)
+            else:
+                safe_namespace = re.sub(r'[^A-Za-z0-9._-]', '_', namespace)
+                filepath = os.path.join(root, safe_namespace + extension)
+
+        self.memory_file = filepath or DEFAULT_MEMORY_FILE_STEM + extension
+        self.store = _make_store(
+            storage,
+            self.memory_file,
+            fsync_policy,
+            scope=namespace or DEFAULT_SQLITE_SCOPE,
+        )
+
+        # 只读的共享层: 跨任务的经验, 本地找不到时才查询
+        shared_filepath = shared_filepath or os.getenv('LOCAL_MEMORY_SHARED_FILE')
+        self.shared_store = None
+        if shared_filepath:
+            shared_storage = _storage_of(shared_filepath)
+            shared_scope = os.getenv(
+                'LOCAL_MEMORY_SHARED_SCOPE', DEFAULT_SHARED_SQLITE_SCOPE
+            )
+            same_file = os.path.abspath(shared_filepath) == os.path.abspath(
+                self.memory_file
+            )
+            # 同一个 sqlite 数据库中的不同 scope 可以作为共享层
+            if not same_file or (
+                shared_storage == STORAGE_SQLITE
+                and shared_scope != getattr(self.store, 'scope', None)
+            ):
+                self.shared_store = _make_store(
+                    shared_storage, shared_filepath, scope=shared_scope
+                )
+
+        self.max_entries = int(
+            max_entries
+            if max_entries is not None
+            else _env_number('LOCAL_MEMORY_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+        )
+        self.max_bytes = int(
+            max_bytes
+            if max_bytes is not None
+            else _env_number('LOCAL_MEMORY_MAX_BYTES', DEFAULT_MAX_BYTES)
+        )
+        self.ttl_seconds = (
+            ttl_seconds
+            if ttl_seconds is not None
+            else _env_number('LOCAL_MEMORY_TTL_SECONDS', DEFAULT_TTL_SECONDS)
+        )
+        self.compress_threshold = int(
+            compress_threshold
+            if compress_threshold is not None
+            else _env_number(
+                'LOCAL_MEMORY_COMPRESS_THRESHOLD', DEFAULT_COMPRESS_THRESHOLD
+            )
+        )
+
+        # 尚未写入的召回统计: {title: (新增召回次数, 最近召回时间)}
+        self._recall_stats: dict[str, tuple[int, float]] = {}
+
+        # 倒排索引, 在保存时增量更新, 检索前与存储同步
+        self._index = MemoryIndex()
+        self._shared_index = MemoryIndex()
+
+        # 异步接口 (asave_memory / arecall_memory) 使用的执行器.
+        # 同一文件的父/子 agent 共用一个, 保证保存顺序并避免并发修改索引
+        self._executor = _acquire_executor(self.memory_file)
+        self._closed = False
+
+    def close(self) -> None:
+        """Flushes the recall stats, closes the stores and releases the executor.
+
+        Call once the agent session is done. The flush runs in the executor after
+        any queued saves; the call itself does not block.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._executor.submit(self._close_stores)
+        _release_executor(self.memory_file)
+
+    def _close_stores(self) -> None:
+        self._flush_recall_stats()
+        for store in (self.store, self.shared_store):
+            # 只有 sqlite 存储持有连接
+            if store is not None and hasattr(store, 'close'):
+                store.close()
+
+    @classmethod
+    def for_session(cls, session_id: str) -> 'LocalMemoryHandler':
+        """Creates the handler for an agent session.
+
+        Memories are namespaced by $LOCAL_MEMORY_NAMESPACE (e.g. the task name) if
+        set, otherwise by the session id. Delegates share their parent's namespace.
+        """
+        namespace = os.getenv('LOCAL_MEMORY_NAMESPACE') or session_id.removesuffix(
+            '-delegate'
+        )
+        return cls(namespace=namespace)
 
     def _load_memories(self) -> dict:  # <-- 1. 返回类型改为 dict
-        """Helper to safely load memories from the file."""
-        if not os.path.exists(self.memory_file):
-            return {}  # 文件不存在，返回空字典
+        """Helper to safely load memories from the store."""
+        return self.store.load()
 
+    def _newest_shared_memories(self, limit: int) -> list[tuple[str, dict]]:
+        """The newest read-only shared memories, newest first (empty if not configured)."""
+        if self.shared_store is None:
+            return []
         try:
-            with open(self.memory_file, "r", encoding="utf-8") as f:
-                memories = json.load(f)
+            return self.shared_store.newest(limit)
+        except Exception:
+            return []
 
-            # 校验: 检查文件内容是否为字典
-            if not isinstance(memories, dict):
-                return {}  # 文件已损坏或格式不正确，返回空字典
+    def _count_shared_memories(self) -> int:
+        """Number of read-only shared memories (0 if not configured)."""
+        if self.shared_store is None:
+            return 0
+        try:
+            return self.shared_store.count()
+        except Exception:
+            return 0
 
-            return memories
-        except (json.JSONDecodeError, IOError):
-            return {}  # 文件为空或已损坏，返回空字典
+    def _get_shared_memory(self, title: str) -> dict | None:
+        """Looks up one read-only shared memory (None if missing or not configured)."""
+        if self.shared_store is None:
+            return None
+        try:
+            return self.shared_store.get(title)
+        except Exception:
+            return None
 
     # 2. 修改 save_memory 的签名
     def save_memory(self, title: str, content_to_save: str) -> str:
@@ -39,54 +454,327 @@ class LocalMemoryHandler:
             if title in memories:
                 return f"Memory title '{title}' already exists, skipped."
 
-            # 添加新记忆 (使用 title 作为 key)
-            new_entry = {"timestamp": time.time(), "content": content_to_save}
-            memories[title] = new_entry
-
-            with open(self.memory_file, "w", encoding="utf-8") as f:
-                json.dump(memories, f, ensure_ascii=False, indent=4)
+            # 添加新记忆 (使用 title 作为 key), 同时记录大小、token 估计和分块边界
+            new_entry = {
+                "timestamp": time.time(),
+                "content": content_to_save,
+                "size_bytes": len(content_to_save.encode('utf-8')),
+                "token_estimate": estimate_tokens(content_to_save),
+                "chunks": compute_chunk_starts(content_to_save),
+            }
+            # 大内容压缩存储, 并记录落盘大小供容量限制使用
+            new_entry = compress_entry(new_entry, self.compress_threshold)
+            new_entry["stored_bytes"] = stored_size(new_entry)
+            self.store.put(title, new_entry)
+            self._index.add(title, new_entry)
 
+            evicted = self._evict(keep=title)
+            if evicted:
+                return (
+                    f"Successfully saved memory with title: {title}. "
+                    f"Evicted {len(evicted)} least recently used or expired memories: {', '.join(evicted)}"
+                )
             return f"Successfully saved memory with title: {title}"
 
         except Exception as e:
             return f"Error processing SaveTaskAction: {e}"
 
+    def _evict(self, keep: str) -> list[str]:
+        """Deletes expired entries, then the least recently used ones until the caps hold.
+
+        Returns the evicted titles. The entry `keep` (the one just saved) is never evicted.
+        """
+        if not self._tracks_recalls:
+            return []
+
+        # 先写入内存中的召回统计, 淘汰顺序以其为准
+        self._flush_recall_stats()
+        memories = self._load_memories()
+        now = time.time()
+        # 最久未使用的在前
+        candidates = sorted(
+            (t for t in memories if t != keep), key=lambda t: last_used(memories[t])
+        )
+        evicted = []
+        if self.ttl_seconds:
+            evicted = [
+                t for t in candidates if now - last_used(memories[t]) > self.ttl_seconds
+            ]
+
+        count = len(memories) - len(evicted)
+        total_bytes = sum(
+            stored_size(entry) for t, entry in memories.items() if t not in evicted
+        )
+        for t in candidates[len(evicted) :]:
+            over_entries = self.max_entries and count > self.max_entries
+            over_bytes = self.max_bytes and total_bytes > self.max_bytes
+            if not (over_entries or over_bytes):
+                break
+            evicted.append(t)
+            count -= 1
+            total_bytes -= stored_size(memories[t])
+
+        if evicted:
+            self.store.delete(evicted)
+            for t in evicted:
+                if t in self._index.indexed:
+                    self._index.remove(t)
+        return evicted
+
+    @property
+    def _tracks_recalls(self) -> bool:
+        """Recall stats are only needed by the LRU caps and the TTL."""
+        return bool(self.max_entries or self.max_bytes or self.ttl_seconds)
+
+    def _record_recall(self, title: str) -> None:
+        """Counts a recall of a local entry in memory (the LRU clock); written in batches."""
+        if not self._tracks_recalls:
+            return
+        count, _ = self._recall_stats.get(title, (0, 0.0))
+        self._recall_stats[title] = (count + 1, time.time())
+        if len(self._recall_stats) >= RECALL_STATS_FLUSH_BATCH:
+            self._flush_recall_stats()
+
+    def _flush_recall_stats(self) -> None:
+        """Writes the pending recall stats to the store in one batch."""
+        if not self._recall_stats:
+            return
+        pending, self._recall_stats = self._recall_stats, {}
+        try:
+            memories = self._load_memories()
+            self.store.put_many(
+                {
+                    t: {
+                        **memories[t],
+                        "recall_count": memories[t].get("recall_count", 0) + count,
+                        "last_recalled": last_recalled,
+                    }
+                    for t, (count, last_recalled) in pending.items()
+                    if t in memories
+                }
+            )
+        except Exception:
+            # 统计信息写入失败不影响召回
+            pass
+
+    async def _run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def asave_memory(self, title: str, content_to_save: str) -> str:
+        """Async save_memory: runs in the memory file's executor, in submission order."""
+        return await self._run_in_executor(self.save_memory, title, content_to_save)
+
+    async def arecall_memory(self, title: str | None, **kwargs) -> str:
+        """Async recall_memory. Queued behind earlier saves, so it sees their entries."""
+        return await self._run_in_executor(self.recall_memory, title, **kwargs)
+
+    def search_memories(
+        self, query: str, top_k: int = DEFAULT_SEARCH_TOP_K
+    ) -> list[tuple[str, dict, float, bool]]:
+        """Keyword search over titles and content.
+
+        Returns up to top_k (title, entry, score, is_shared) tuples, best first.
+        Local entries shadow shared entries with the same title.
+        """
+        results = [
+            (t, entry, score, False)
+            for t, entry, score in self._search_store(self.store, self._index, query, top_k)
+        ]
+        if self.shared_store is not None:
+            results += [
+                (t, entry, score, True)
+                for t, entry, score in self._search_store(
+                    self.shared_store, self._shared_index, query, top_k
+                )
+                if self.store.get(t) is None
+            ]
+        results.sort(key=lambda result: result[2], reverse=True)
+        return results[:top_k]
+
+    @staticmethod
+    def _search_store(
+        store, index: MemoryIndex, query: str, top_k: int
+    ) -> list[tuple[str, dict, float]]:
+        """(title, entry, score) matches of one store, best first.
+
+        Uses the store's own full-text search if it has one (sqlite) and fetches only
+        the matching entries, else the inverted index over the loaded entries.
+        """
+        if hasattr(store, 'search'):
+            matches = []
+            for t, score in store.search(query, top_k, title_weight=TITLE_TERM_WEIGHT):
+                entry = store.get(t)
+                if entry is not None:
+                    matches.append((t, entry, score))
+            return matches
+        memories = store.load()
+        index.sync(memories)
+        return [(t, memories[t], score) for t, score in index.search(query) if t in memories]
+
+    def _is_empty(self) -> bool:
+        """Whether neither the local nor the shared memories have any entry."""
+        return not self.store.count() and not self._count_shared_memories()
+
     # 3. 修改 recall_all_memories 为 recall_memory
-    def recall_memory(self, title: str | None) -> str:
+    def recall_memory(
+        self,
+        title: str | None,
+        query: str | None = None,
+        top_k: int = DEFAULT_SEARCH_TOP_K,
+        chunk: int | None = None,
+        offset: int | None = None,
+        max_chars: int | None = None,
+    ) -> str:
         """
         Recalls memories.
-        If title is None, returns the outline (all titles).
-        If title is provided, returns the specific content.
+        If title is None and query is None, returns the outline (all titles, with sizes).
+        If title is provided, returns the specific content: the zero-based `chunk`, or
+        `max_chars` characters from `offset`. Without either, content longer than
+        DEFAULT_RECALL_MAX_CHARS is returned as its first chunk.
+        If only query is provided, returns the top_k entries matching its keywords, with snippets.
         """
         try:
-            memories = self._load_memories()
-            if not memories:
+            if title is not None:
+                return self._recall_details(title, chunk, offset, max_chars)
+
+            if self._is_empty():
                 return "No memory file found or memory is empty. Nothing to recall."
 
-            # 4. 实现新的 "大纲" 或 "详情" 逻辑
-            if title is None:
+            # 4. 实现新的 "大纲" / "详情" / "检索" 逻辑 (详情见 _recall_details)
+            if query:
                 # ===================
-                # 逻辑: 返回大纲
+                # 逻辑: 关键词检索
                 # ===================
-                all_titles = list(memories.keys())
-                if not all_titles:
-                    return "Memory is empty. No titles to recall."
+                results = self.search_memories(query, top_k)
+                if not results:
+                    return f"No memories match the query '{query}'. Recall without arguments to see all titles."
 
-                formatted_outline = "\n".join([f"- {t}" for t in all_titles])
-                return f"Successfully recalled memory outline:\n{formatted_outline}"
+                formatted_results = "\n".join(
+                    f"{i}. {t}{' (shared)' if is_shared else ''} [score {score:.2f}]\n"
+                    f"   {make_snippet(entry_content(entry), query)}"
+                    for i, (t, entry, score, is_shared) in enumerate(results, 1)
+                )
+                return (
+                    f"Successfully searched memories for '{query}' (top {len(results)}):\n{formatted_results}\n"
+                    "Recall a title to get its full content."
+                )
 
             else:
                 # ===================
-                # 逻辑: 返回详情
+                # 逻辑: 返回大纲
                 # ===================
-                if title not in memories:
-                    return f"Error: Memory with title '{title}' not found."
+                memories = self._load_memories()
+                all_titles = list(memories.keys())
+                # 共享层可能很大: 只列出最新的 SHARED_OUTLINE_MAX_TITLES 条 (按时间顺序),
+                # 其余只给出数量. 被本地同名记忆覆盖的标题不再重复列出
+                newest_shared = self._newest_shared_memories(
+                    SHARED_OUTLINE_MAX_TITLES + len(memories)
+                )
+                shared = [(t, entry) for t, entry in newest_shared if t not in memories]
+                listed_shared = shared[:SHARED_OUTLINE_MAX_TITLES][::-1]
+                unlisted_shared = (
+                    self._count_shared_memories()
+                    - len(newest_shared)
+                    + len(shared)
+                    - len(listed_shared)
+                )
+                if not all_titles and not listed_shared:
+                    return "Memory is empty. No titles to recall."
 
-                # 返回特定标题的内容
-                entry = memories[title]
-                content = entry.get('content', 'No content found.')
-                ts = entry.get('timestamp', 'N/A')
-                return f"Successfully recalled memory '{title}' (Timestamp: {ts}):\n{content}"
+                formatted_outline = "\n".join(
+                    [f"- {t} ({describe_size(memories[t])})" for t in all_titles]
+                )
+                if listed_shared:
+                    formatted_shared = "\n".join(
+                        [f"- {t} ({describe_size(entry)})" for t, entry in listed_shared]
+                    )
+                    if unlisted_shared > 0:
+                        formatted_shared += (
+                            f"\n... and {unlisted_shared} older shared memories, "
+                            "recall with a query to search them."
+                        )
+                    formatted_outline = (
+                        f"{formatted_outline}\nShared memories (read-only, newest {len(listed_shared)}):\n{formatted_shared}"
+                    ).lstrip("\n")
+                return f"Successfully recalled memory outline:\n{formatted_outline}"
 
         except Exception as e:
             return f"Error recalling memories: {e}"
+
+    def _recall_details(
+        self,
+        title: str,
+        chunk: int | None,
+        offset: int | None,
+        max_chars: int | None,
+    ) -> str:
+        """Returns the content of one memory (see recall_memory)."""
+        # ===================
+        # 逻辑: 返回详情
+        # 按标题直接查询 (sqlite 为主键点查), 本地找不到时才查询共享层
+        # ===================
+        source = ""
+        entry = self.store.get(title)
+        if entry is not None:
+            self._record_recall(title)
+        else:
+            entry = self._get_shared_memory(title)
+            if entry is None:
+                if self._is_empty():
+                    return "No memory file found or memory is empty. Nothing to recall."
+                return f"Error: Memory with title '{title}' not found."
+            source = " from shared memory"
+
+        # 返回特定标题的内容 (按需分块)
+        content = entry_content(entry) or 'No content found.'
+        ts = entry.get('timestamp', 'N/A')
+        start, end, part = self._select_range(entry, content, chunk, offset, max_chars)
+        if part is None:
+            return f"Successfully recalled memory '{title}'{source} (Timestamp: {ts}):\n{content}"
+
+        return (
+            f"Successfully recalled memory '{title}'{source} (Timestamp: {ts}), {part}:\n"
+            f"{content[start:end]}\n"
+            f"[Showing characters {start}-{end} of {len(content)} (~{estimate_tokens(content)} tokens in total)."
+            + (
+                f" Recall with offset={end} (or the next chunk) to continue.]"
+                if end < len(content)
+                else " This is the end of the memory.]"
+            )
+        )
+
+    @staticmethod
+    def _select_range(
+        entry: dict,
+        content: str,
+        chunk: int | None,
+        offset: int | None,
+        max_chars: int | None,
+    ) -> tuple[int, int, str | None]:
+        """Resolves chunk/offset/max_chars into (start, end, description).
+
+        The description is None when the whole content should be returned.
+        """
+        if chunk is not None:
+            starts = entry.get('chunks') or compute_chunk_starts(content)
+            if not 0 <= chunk < len(starts):
+                raise ValueError(
+                    f'chunk {chunk} is out of range, the memory has {len(starts)} chunk(s) numbered from 0'
+                )
+            end = starts[chunk + 1] if chunk + 1 < len(starts) else len(content)
+            return starts[chunk], end, f'chunk {chunk} of {len(starts)} (numbered from 0)'
+
+        if offset is not None or max_chars is not None:
+            start = max(0, offset or 0)
+            end = min(len(content), start + max(1, max_chars or DEFAULT_RECALL_MAX_CHARS))
+            return start, end, f'characters from offset {start}'
+
+        if len(content) > DEFAULT_RECALL_MAX_CHARS:
+            starts = entry.get('chunks') or compute_chunk_starts(content)
+            end = starts[1] if len(starts) > 1 else len(content)
+            return 0, end, f'chunk 0 of {len(starts)} (numbered from 0, the memory is large)'
+
+        return 0, len(content), None
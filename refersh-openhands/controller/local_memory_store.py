@@ -0,0 +1,620 @@
+# openhands/controller/local_memory_store.py
+import base64
+import heapq
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl  # For file locking between parallel runs sharing a memory file
+except ImportError:  # Windows: no advisory locking
+    fcntl = None
+
+try:
+    import zstandard  # Optional: better ratio/speed than zlib for compressed entries
+except ImportError:
+    zstandard = None
+
+from openhands.core.logger import openhands_logger as logger
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_ZSTD = 'zstd'
+
+
+def compress_entry(entry: dict, threshold: int) -> dict:
+    """Returns the entry with its content compressed if it is at least `threshold` bytes.
+
+    The compressed content is stored base64-encoded under 'content_z', with the
+    codec under 'compression'. Use `entry_content` to read it back.
+    """
+    content = entry.get('content')
+    if threshold <= 0 or not isinstance(content, str):
+        return entry
+    raw = content.encode('utf-8')
+    if len(raw) < threshold:
+        return entry
+
+    if zstandard is not None:
+        codec, packed = COMPRESSION_ZSTD, zstandard.ZstdCompressor().compress(raw)
+    else:
+        codec, packed = COMPRESSION_ZLIB, zlib.compress(raw, 6)
+    if len(packed) * 4 // 3 >= len(raw):
+        return entry  # incompressible: base64 would make it bigger
+
+    compressed = {k: v for k, v in entry.items() if k != 'content'}
+    compressed['compression'] = codec
+    compressed['content_z'] = base64.b64encode(packed).decode('ascii')
+    return compressed
+
+
+def entry_content(entry: dict) -> str:
+    """The (decompressed) content of a stored entry."""
+    codec = entry.get('compression')
+    if codec is None:
+        return str(entry.get('content', ''))
+
+    packed = base64.b64decode(entry['content_z'])
+    if codec == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise RuntimeError(
+                'This memory is zstd-compressed. Install the zstandard package to read it.'
+            )
+        raw = zstandard.ZstdDecompressor().decompress(packed)
+    elif codec == COMPRESSION_ZLIB:
+        raw = zlib.decompress(packed)
+    else:
+        raise ValueError(f'Unknown memory compression: {codec}')
+    return raw.decode('utf-8')
+
+
+def stored_size(entry: dict) -> int:
+    """Approximate bytes an entry takes on disk."""
+    size = entry.get('stored_bytes')
+    if size is None:
+        size = len(json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+    return size
+
+
+def newest_entries(memories: dict, limit: int) -> list[tuple[str, dict]]:
+    """The `limit` most recently saved (title, entry) pairs, newest first."""
+    return heapq.nlargest(
+        limit, memories.items(), key=lambda item: item[1].get('timestamp') or 0
+    )
+
+
+@contextmanager
+def file_lock(filepath: str, exclusive: bool = True):
+    """Holds an fcntl lock on `<filepath>.lock` for the duration of the block.
+
+    A sidecar lock file is used because the memory file itself may be replaced
+    (os.replace) while the lock is held.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with open(f'{filepath}.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class JsonMemoryStore:
+    """Stores all memories as one JSON dict (the original format).
+
+    Every write rewrites the whole file under an exclusive lock, re-reading it
+    first so concurrent writers don't lose each other's entries, and swaps it in
+    atomically so readers never see a half-written file. The parsed dict is
+    cached in memory and only re-parsed when the file's (mtime_ns, size)
+    signature changes, i.e. when another process wrote to it.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        # 内存缓存: 解析后的字典, 以及解析时文件的 (mtime_ns, size) 签名
+        self._cache: dict | None = None
+        self._cache_signature: tuple[int, int] | None = None
+
+    def _file_signature(self) -> tuple[int, int] | None:
+        """Returns (mtime_ns, size) of the memory file, or None if it does not exist."""
+        try:
+            stat = os.stat(self.filepath)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self) -> dict:
+        """Returns all memories as a {title: entry} dict. Do not mutate the result."""
+        signature = self._file_signature()
+        if signature is None:
+            self._cache, self._cache_signature = None, None
+            return {}  # 文件不存在，返回空字典
+
+        # 缓存命中: 文件自上次解析后未被修改
+        if self._cache is not None and signature == self._cache_signature:
+            return self._cache
+
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as f:
+                memories = json.load(f)
+
+            # 校验: 检查文件内容是否为字典
+            if not isinstance(memories, dict):
+                memories = {}  # 文件已损坏或格式不正确，返回空字典
+        except (json.JSONDecodeError, IOError):
+            memories = {}  # 文件为空或已损坏，返回空字典
+
+        # 使用读取前的签名: 如果读取期间文件被修改, 下次调用时签名不一致会重新解析
+        self._cache, self._cache_signature = memories, signature
+        return memories
+
+    def get(self, title: str) -> dict | None:
+        """Returns one memory entry, or None. Do not mutate the result."""
+        return self.load().get(title)
+
+    def count(self) -> int:
+        """Number of memory entries."""
+        return len(self.load())
+
+    def newest(self, limit: int) -> list[tuple[str, dict]]:
+        """The `limit` most recently saved (title, entry) pairs, newest first."""
+        return newest_entries(self.load(), limit)
+
+    def put(self, title: str, entry: dict) -> None:
+        """Adds or replaces one memory entry and rewrites the file."""
+        self.put_many({title: entry})
+
+    def put_many(self, entries: dict) -> None:
+        """Adds or replaces several memory entries with a single rewrite."""
+        if not entries:
+            return
+        with file_lock(self.filepath):
+            memories = dict(self.load())
+            memories.update(entries)
+            self._write(memories)
+
+    def delete(self, titles) -> None:
+        """Removes the given memory entries (missing titles are ignored)."""
+        with file_lock(self.filepath):
+            memories = dict(self.load())
+            removed = [memories.pop(title) for title in titles if title in memories]
+            if removed:
+                self._write(memories)
+
+    def _write(self, memories: dict) -> None:
+        """Atomically replaces the file. Must be called with the lock held."""
+        tmp_path = f'{self.filepath}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            # 紧凑格式, 不再缩进, 减小文件体积
+            json.dump(memories, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self.filepath)
+
+        # 更新缓存签名, 避免下次读取时重新解析自己刚写入的文件
+        self._cache, self._cache_signature = memories, self._file_signature()
+
+
+class JsonlJournalMemoryStore:
+    """Stores memories in an append-only JSONL journal.
+
+    Each save appends one `{"op": "put", "title": ..., "entry": ...}` line, so a
+    save costs O(1) instead of rewriting the whole file, and a crash can at worst
+    leave a partial last line, which replay skips. Replay is incremental: only the
+    bytes appended since the last load are parsed. When the journal holds many
+    more records than live entries it is compacted into a fresh file and swapped
+    in atomically with os.replace. Appends and compaction hold an exclusive lock;
+    readers need none, since they only consume complete lines and detect a
+    swapped-in file by its inode.
+
+    Args:
+        filepath: Path of the JSONL journal.
+        fsync_policy: 'always' fsyncs after every append, 'interval' at most every
+            `fsync_interval` seconds, 'never' leaves flushing to the OS.
+        fsync_interval: Minimum seconds between fsyncs for the 'interval' policy.
+        compact_ratio: Compact when the journal has more than this many records
+            per live entry.
+        compact_min_records: Never compact journals with fewer records than this.
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        fsync_policy: str = FSYNC_ALWAYS,
+        fsync_interval: float = 1.0,
+        compact_ratio: float = 2.0,
+        compact_min_records: int = 64,
+    ):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(
+                f'Unknown fsync policy: {fsync_policy}. Expected one of {FSYNC_POLICIES}'
+            )
+        self.filepath = filepath
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+
+        self._memories: dict = {}
+        self._records = 0  # number of journal records replayed, including superseded ones
+        self._offset = 0  # bytes of the journal consumed so far (always at a line boundary)
+        self._inode: int | None = None
+        self._last_fsync = 0.0
+
+    def _reset(self) -> None:
+        self._memories = {}
+        self._records = 0
+        self._offset = 0
+        self._inode = None
+
+    def _apply(self, record: dict) -> None:
+        op = record.get('op')
+        title = record.get('title')
+        if not isinstance(title, str):
+            return
+        if op == 'put' and isinstance(record.get('entry'), dict):
+            self._memories[title] = record['entry']
+            self._records += 1
+        elif op == 'delete':
+            self._memories.pop(title, None)
+            self._records += 1
+
+    def _replay(self) -> None:
+        """Parses the journal bytes appended since the last replay."""
+        try:
+            stat = os.stat(self.filepath)
+        except OSError:
+            self._reset()
+            return
+
+        # The file was replaced (compacted) or truncated: replay from scratch
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._reset()
+            self._inode = stat.st_ino
+
+        if stat.st_size == self._offset:
+            return
+
+        with open(self.filepath, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+
+        # Only consume complete lines; a partial last line is either still being
+        # written by another process or the remains of a crash
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                logger.warning(
+                    f'Skipping corrupt record in memory journal {self.filepath}'
+                )
+                # Count it so that compaction eventually drops it
+                self._records += 1
+                continue
+            if isinstance(record, dict):
+                self._apply(record)
+        self._offset += end
+
+    def load(self) -> dict:
+        """Returns all memories as a {title: entry} dict. Do not mutate the result."""
+        self._replay()
+        return self._memories
+
+    def get(self, title: str) -> dict | None:
+        """Returns one memory entry, or None. Do not mutate the result."""
+        return self.load().get(title)
+
+    def count(self) -> int:
+        """Number of live memory entries."""
+        return len(self.load())
+
+    def newest(self, limit: int) -> list[tuple[str, dict]]:
+        """The `limit` most recently saved (title, entry) pairs, newest first."""
+        return newest_entries(self.load(), limit)
+
+    def _append(self, *records: dict) -> None:
+        line = ''.join(
+            json.dumps(record, ensure_ascii=False) + '\n' for record in records
+        ).encode('utf-8')
+
+        with file_lock(self.filepath), open(self.filepath, 'a+b') as f:
+            # If a previous writer crashed mid-line, terminate the partial line first
+            # so this record is not glued onto it (replay skips the broken line)
+            size = f.seek(0, os.SEEK_END)
+            if size > 0:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    line = b'\n' + line
+            f.write(line)
+            f.flush()
+
+            now = time.monotonic()
+            if self.fsync_policy == FSYNC_ALWAYS or (
+                self.fsync_policy == FSYNC_INTERVAL
+                and now - self._last_fsync >= self.fsync_interval
+            ):
+                os.fsync(f.fileno())
+                self._last_fsync = now
+
+        # Pick up our own record (and anything appended before it)
+        self._replay()
+
+    def put(self, title: str, entry: dict) -> None:
+        """Appends one memory entry to the journal."""
+        self.put_many({title: entry})
+
+    def put_many(self, entries: dict) -> None:
+        """Appends several memory entries to the journal in one write."""
+        if not entries:
+            return
+        self._replay()
+        self._append(
+            *(
+                {'op': 'put', 'title': title, 'entry': entry}
+                for title, entry in entries.items()
+            )
+        )
+        self._maybe_compact()
+
+    def delete(self, titles) -> None:
+        """Appends delete records for the given titles (missing titles are ignored)."""
+        self._replay()
+        records = [
+            {'op': 'delete', 'title': title}
+            for title in titles
+            if title in self._memories
+        ]
+        if records:
+            self._append(*records)
+            self._maybe_compact()
+
+    def _maybe_compact(self) -> None:
+        if self._records < self.compact_min_records:
+            return
+        if self._records <= self.compact_ratio * max(len(self._memories), 1):
+            return
+        self.compact()
+
+    def compact(self) -> None:
+        """Rewrites the journal with one record per live entry."""
+        with file_lock(self.filepath):
+            # Replay under the lock so no concurrent append is lost
+            self._replay()
+            tmp_path = f'{self.filepath}.compact.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for title, entry in self._memories.items():
+                    record = {'op': 'put', 'title': title, 'entry': entry}
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                f.flush()
+                if self.fsync_policy != FSYNC_NEVER:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self.filepath)
+
+        logger.debug(
+            f'Compacted memory journal {self.filepath}: '
+            f'{self._records} records -> {len(self._memories)}'
+        )
+        # Re-read the compacted file so offset/inode track the new file
+        self._reset()
+        self._replay()
+
+
+class SqliteMemoryStore:
+    """Stores memories in a SQLite database shared by many task runs.
+
+    Entries live in a `memories` table keyed by (scope, title), where the scope
+    is the session/task namespace, so one database can hold the memories of
+    every run. Titles and contents are indexed by an external-content FTS5
+    table kept in sync by triggers, and `search` ranks matches with bm25. The
+    database runs in WAL mode, so readers from other runs never block on a
+    writer, and writers wait up to `busy_timeout` seconds for each other.
+
+    `load` returns the entries of this store's scope and is cached until another
+    connection commits (tracked with `PRAGMA data_version`). `get`, `count`,
+    `newest` and `search` query the table directly, without loading the scope.
+
+    Args:
+        filepath: Path of the SQLite database.
+        scope: Namespace of this store's entries.
+        busy_timeout: Seconds to wait for a lock held by another connection.
+    """
+
+    def __init__(self, filepath: str, scope: str = 'default', busy_timeout: float = 5.0):
+        self.filepath = filepath
+        self.scope = scope
+        # One connection per store; the lock serializes its use across threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            filepath, timeout=busy_timeout, check_same_thread=False
+        )
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS memories (
+                    scope TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp REAL NOT NULL,
+                    entry TEXT NOT NULL,
+                    PRIMARY KEY (scope, title)
+                );
+                CREATE INDEX IF NOT EXISTS memories_timestamp ON memories (scope, timestamp);
+                CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5(
+                    title, content, content='memories', content_rowid='rowid'
+                );
+                CREATE TRIGGER IF NOT EXISTS memories_ai AFTER INSERT ON memories BEGIN
+                    INSERT INTO memories_fts (rowid, title, content)
+                    VALUES (new.rowid, new.title, new.content);
+                END;
+                CREATE TRIGGER IF NOT EXISTS memories_ad AFTER DELETE ON memories BEGIN
+                    INSERT INTO memories_fts (memories_fts, rowid, title, content)
+                    VALUES ('delete', old.rowid, old.title, old.content);
+                END;
+                CREATE TRIGGER IF NOT EXISTS memories_au AFTER UPDATE ON memories BEGIN
+                    INSERT INTO memories_fts (memories_fts, rowid, title, content)
+                    VALUES ('delete', old.rowid, old.title, old.content);
+                    INSERT INTO memories_fts (rowid, title, content)
+                    VALUES (new.rowid, new.title, new.content);
+                END;
+                """
+            )
+
+        self._cache: dict | None = None
+        self._cache_version: int | None = None
+
+    def _data_version(self) -> int:
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def load(self) -> dict:
+        """Returns this scope's memories as a {title: entry} dict. Do not mutate the result."""
+        with self._lock:
+            version = self._data_version()
+            if self._cache is not None and version == self._cache_version:
+                return self._cache
+
+            memories = {}
+            rows = self._conn.execute(
+                'SELECT title, entry FROM memories WHERE scope = ? ORDER BY timestamp, rowid',
+                (self.scope,),
+            )
+            for title, entry in rows:
+                try:
+                    memories[title] = json.loads(entry)
+                except json.JSONDecodeError:
+                    logger.warning(
+                        f'Skipping corrupt memory {title!r} in {self.filepath}'
+                    )
+            self._cache, self._cache_version = memories, version
+            return memories
+
+    def get(self, title: str) -> dict | None:
+        """Returns one entry of this scope, or None (an indexed point lookup)."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT entry FROM memories WHERE scope = ? AND title = ?',
+                (self.scope, title),
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            return json.loads(row[0])
+        except json.JSONDecodeError:
+            logger.warning(f'Skipping corrupt memory {title!r} in {self.filepath}')
+            return None
+
+    def count(self) -> int:
+        """Number of entries in this scope, without loading them."""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM memories WHERE scope = ?', (self.scope,)
+            ).fetchone()[0]
+
+    def newest(self, limit: int) -> list[tuple[str, dict]]:
+        """The `limit` most recently saved (title, entry) pairs of this scope, newest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT title, entry FROM memories WHERE scope = ? '
+                'ORDER BY timestamp DESC, rowid DESC LIMIT ?',
+                (self.scope, limit),
+            ).fetchall()
+        newest = []
+        for title, entry in rows:
+            try:
+                newest.append((title, json.loads(entry)))
+            except json.JSONDecodeError:
+                logger.warning(f'Skipping corrupt memory {title!r} in {self.filepath}')
+        return newest
+
+    def put(self, title: str, entry: dict) -> None:
+        """Adds or replaces one memory entry of this scope."""
+        self.put_many({title: entry})
+
+    def put_many(self, entries: dict) -> None:
+        """Adds or replaces several memory entries of this scope in one transaction."""
+        if not entries:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    """
+                    INSERT INTO memories (scope, title, content, timestamp, entry)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (scope, title) DO UPDATE SET
+                        content = excluded.content,
+                        timestamp = excluded.timestamp,
+                        entry = excluded.entry
+                    """,
+                    [
+                        (
+                            self.scope,
+                            title,
+                            entry_content(entry),
+                            float(entry.get('timestamp') or time.time()),
+                            json.dumps(entry, ensure_ascii=False),
+                        )
+                        for title, entry in entries.items()
+                    ],
+                )
+            # data_version does not change for our own commits: update the cache directly
+            if self._cache is not None:
+                self._cache = {**self._cache, **entries}
+
+    def delete(self, titles) -> None:
+        """Removes the given memory entries of this scope (missing titles are ignored)."""
+        titles = set(titles)
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    'DELETE FROM memories WHERE scope = ? AND title = ?',
+                    [(self.scope, title) for title in titles],
+                )
+            if self._cache is not None:
+                self._cache = {
+                    t: e for t, e in self._cache.items() if t not in titles
+                }
+
+    def search(
+        self, query: str, limit: int, title_weight: float = 1.0
+    ) -> list[tuple[str, float]]:
+        """Full-text search of this scope: (title, score) pairs, best first.
+
+        Any word of the query may match, as a word or a word prefix, so 'gitlab'
+        also matches 'GitLabCredentials'. Scores are negated bm25 ranks (higher is
+        better).
+        """
+        # Quote every word so FTS5 syntax in the query is taken literally
+        words = dict.fromkeys(word.lower() for word in re.findall(r'\w+', query))
+        match = ' OR '.join('"{}"*'.format(word) for word in words)
+        if not match:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT m.title, -bm25(memories_fts, ?, 1.0) AS score
+                FROM memories_fts JOIN memories AS m ON m.rowid = memories_fts.rowid
+                WHERE memories_fts MATCH ? AND m.scope = ?
+                ORDER BY score DESC
+                LIMIT ?
+                """,
+                (title_weight, match, self.scope, limit),
+            ).fetchall()
+        return [(title, score) for title, score in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
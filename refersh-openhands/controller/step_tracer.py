@@ -0,0 +1,173 @@
+"""Opt-in per-step phase timing, exported as Chrome trace events.
+
+Set OPENHANDS_STEP_TRACE_DIR to a directory to enable it. Each process then writes
+one trace file per run, `step-trace-<timestamp>-<pid>.json`, in the Chrome trace
+event JSON array format (or one event per line with OPENHANDS_STEP_TRACE_FORMAT=jsonl).
+The .json files open directly in chrome://tracing or https://ui.perfetto.dev; a
+run that was killed leaves the array unterminated, which both viewers accept.
+
+Every agent session gets its own track (tid), and every span carries the session
+id and step (iteration) in its args, so whole evaluation runs can be profiled in
+one viewer.
+"""
+
+from __future__ import annotations
+
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+from openhands.core.logger import openhands_logger as logger
+
+TRACE_FORMAT_JSON = 'json'
+TRACE_FORMAT_JSONL = 'jsonl'
+
+# (session_id, step) of the step being traced in the current task/thread
+_current_step: contextvars.ContextVar[tuple[str, int] | None] = contextvars.ContextVar(
+    'openhands_current_step', default=None
+)
+
+
+def now_us() -> float:
+    """Timestamp for `StepTracer.record`, in microseconds."""
+    return time.perf_counter_ns() / 1000
+
+
+class StepTracer:
+    """Writes complete ('X') trace events for named spans.
+
+    Args:
+        trace_dir: Directory of the trace file.
+        trace_format: 'json' (Chrome JSON array) or 'jsonl' (one event per line).
+    """
+
+    def __init__(self, trace_dir: str, trace_format: str = TRACE_FORMAT_JSON):
+        if trace_format not in (TRACE_FORMAT_JSON, TRACE_FORMAT_JSONL):
+            raise ValueError(f'Unknown step trace format: {trace_format}')
+        os.makedirs(trace_dir, exist_ok=True)
+        self.trace_format = trace_format
+        self.path = os.path.join(
+            trace_dir,
+            f'step-trace-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.{trace_format}',
+        )
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._tids: dict[str, int] = {}
+        self._file = open(self.path, 'w', encoding='utf-8')
+        if trace_format == TRACE_FORMAT_JSON:
+            self._file.write('[\n')
+        atexit.register(self.close)
+        logger.info(f'Writing step traces to {self.path}')
+
+    def _tid(self, session_id: str) -> int:
+        """Track id of a session; announces the session name to the viewer on first use."""
+        tid = self._tids.get(session_id)
+        if tid is None:
+            tid = self._tids[session_id] = len(self._tids) + 1
+            self._write(
+                {
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': self._pid,
+                    'tid': tid,
+                    'args': {'name': session_id},
+                }
+            )
+        return tid
+
+    def _write(self, event: dict) -> None:
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        self._file.write(
+            line + (',\n' if self.trace_format == TRACE_FORMAT_JSON else '\n')
+        )
+        self._file.flush()
+
+    def record(
+        self,
+        name: str,
+        start_us: float,
+        end_us: float,
+        session_id: str | None = None,
+        step: int | None = None,
+        **args: Any,
+    ) -> None:
+        """Records a finished span. Session and step default to the current step's."""
+        current = _current_step.get()
+        if session_id is None and current is not None:
+            session_id, current_step = current
+            step = current_step if step is None else step
+        session_id = session_id or 'unknown'
+        with self._lock:
+            if self._file.closed:
+                return
+            self._write(
+                {
+                    'name': name,
+                    'cat': name.split('.', 1)[0],
+                    'ph': 'X',
+                    'ts': start_us,
+                    'dur': max(end_us - start_us, 0),
+                    'pid': self._pid,
+                    'tid': self._tid(session_id),
+                    'args': {'session_id': session_id, 'step': step, **args},
+                }
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+_tracer: StepTracer | None = None
+_tracer_initialized = False
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> StepTracer | None:
+    """The process-wide tracer, or None if OPENHANDS_STEP_TRACE_DIR is not set."""
+    global _tracer, _tracer_initialized
+    if not _tracer_initialized:
+        with _tracer_lock:
+            if not _tracer_initialized:
+                trace_dir = os.getenv('OPENHANDS_STEP_TRACE_DIR')
+                if trace_dir:
+                    _tracer = StepTracer(
+                        trace_dir,
+                        os.getenv('OPENHANDS_STEP_TRACE_FORMAT', TRACE_FORMAT_JSON),
+                    )
+                _tracer_initialized = True
+    return _tracer
+
+
+@contextmanager
+def trace_span(name: str, **args: Any) -> Iterator[None]:
+    """Times the block as a span of the current step. A no-op when tracing is off."""
+    tracer = get_tracer()
+    if tracer is None:
+        yield
+        return
+    start = now_us()
+    try:
+        yield
+    finally:
+        tracer.record(name, start, now_us(), **args)
+
+
+@contextmanager
+def trace_step(session_id: str, step: int) -> Iterator[None]:
+    """Marks the block as step `step` of `session_id` and times it as a 'step' span."""
+    if get_tracer() is None:
+        yield
+        return
+    token = _current_step.set((session_id, step))
+    try:
+        with trace_span('step'):
+            yield
+    finally:
+        _current_step.reset(token)
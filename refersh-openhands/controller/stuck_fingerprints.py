@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import dataclasses
+from collections import deque
+from enum import Enum
+
+from openhands.events import EventSource
+from openhands.events.action import Action, MessageAction, NullAction
+from openhands.events.action.commands import IPythonRunCellAction
+from openhands.events.event import Event
+from openhands.events.observation import (
+    CmdOutputObservation,
+    ErrorObservation,
+    IPythonRunCellObservation,
+    NullObservation,
+    Observation,
+)
+from openhands.events.observation.agent import AgentCondensationObservation
+
+# StuckDetector looks at no more than the last 6 actions and observations
+WINDOW = 6
+# and at the last 10 AgentCondensationObservations
+CONDENSATION_LOOP_LENGTH = 10
+
+OBSERVATION_ERROR = 'error'
+OBSERVATION_IPYTHON = 'ipython'
+
+_PRIMITIVE_TYPES = (str, int, float, bool, type(None), Enum)
+
+
+def event_fingerprint(event: Event) -> int:
+    """Hash of the parts of an event that StuckDetector compares.
+
+    Events that StuckDetector considers equal always have the same fingerprint
+    (the converse does not hold): IPython actions are keyed by their first three
+    lines of code, command outputs by command and exit code, and other events by
+    their type and the primitive values of their compared dataclass fields.
+    """
+    if isinstance(event, IPythonRunCellAction):
+        key: tuple = (IPythonRunCellAction, tuple(event.code.split('\n')[:3]))
+    elif isinstance(event, CmdOutputObservation):
+        key = (CmdOutputObservation, event.command, event.exit_code)
+    elif dataclasses.is_dataclass(event):
+        key = (type(event),) + tuple(
+            value
+            for value in (
+                getattr(event, f.name, None)
+                for f in dataclasses.fields(event)
+                if f.compare
+            )
+            if isinstance(value, _PRIMITIVE_TYPES)
+        )
+    else:
+        key = (type(event),)
+    return hash(key)
+
+
+def _repeats(fingerprints: list[int], count: int, step: int = 1) -> bool:
+    """True if the newest `count` fingerprints, taken every `step`, are all equal."""
+    if len(fingerprints) < (count - 1) * step + 1:
+        return False
+    newest = fingerprints[-1]
+    return all(fingerprints[-1 - i * step] == newest for i in range(1, count))
+
+
+class LoopFingerprints:
+    """Rolling fingerprints of the recent history, to rule out loops in O(1).
+
+    Keeps fixed-size ring buffers of action and observation fingerprints (with
+    the same filtering as StuckDetector: no user messages, no null events), the
+    last agent messages and the recent condensation observations. `may_be_stuck`
+    is a necessary condition for every StuckDetector scenario, so the controller
+    only runs the full detector when it returns True, and gets the same result.
+
+    Like HistoryIndex, it is tied to one history list and `sync` rebuilds it if
+    the list was replaced or modified other than by appending.
+    """
+
+    def __init__(self) -> None:
+        self._history: list[Event] | None = None
+        self._length = 0
+        self._last_id: int | None = None
+        self.actions: deque[int] = deque(maxlen=WINDOW)
+        self.observations: deque[int] = deque(maxlen=WINDOW)
+        self.observation_kinds: deque[str | None] = deque(maxlen=WINDOW)
+        # agent messages and, for each, whether an observation came before it since the previous one
+        self.agent_messages: deque[int] = deque(maxlen=3)
+        self.observation_before_message: deque[bool] = deque(maxlen=3)
+        self._observation_since_message = False
+        # condensation observations and, for each, whether it directly follows another
+        self.condensations = 0
+        self.condensation_follows: deque[bool] = deque(
+            maxlen=CONDENSATION_LOOP_LENGTH - 1
+        )
+        self._previous_was_condensation = False
+
+    def __len__(self) -> int:
+        return self._length
+
+    def _reset(self, history: list[Event]) -> None:
+        self.__init__()  # type: ignore[misc]
+        self._history = history
+
+    def _add(self, event: Event) -> None:
+        self._length += 1
+        self._last_id = event.id
+        if (
+            isinstance(event, MessageAction) and event.source == EventSource.USER
+        ) or isinstance(event, (NullAction, NullObservation)):
+            return
+
+        is_condensation = isinstance(event, AgentCondensationObservation)
+        if is_condensation:
+            self.condensations += 1
+            self.condensation_follows.append(self._previous_was_condensation)
+        self._previous_was_condensation = is_condensation
+
+        if isinstance(event, Action):
+            fingerprint = event_fingerprint(event)
+            self.actions.append(fingerprint)
+            if isinstance(event, MessageAction) and event.source == EventSource.AGENT:
+                self.agent_messages.append(fingerprint)
+                self.observation_before_message.append(
+                    self._observation_since_message
+                )
+                self._observation_since_message = False
+        elif isinstance(event, Observation):
+            self.observations.append(event_fingerprint(event))
+            if isinstance(event, ErrorObservation):
+                kind: str | None = OBSERVATION_ERROR
+            elif isinstance(event, IPythonRunCellObservation):
+                kind = OBSERVATION_IPYTHON
+            else:
+                kind = None
+            self.observation_kinds.append(kind)
+            self._observation_since_message = True
+
+    def _in_sync(self, history: list[Event]) -> bool:
+        if history is not self._history or len(history) < len(self):
+            return False
+        return len(self) == 0 or history[len(self) - 1].id == self._last_id
+
+    def sync(self, history: list[Event]) -> None:
+        """Adds the events appended to `history` since the last call (rebuilding if needed)."""
+        if not self._in_sync(history):
+            self._reset(history)
+        for event in history[len(self) :]:
+            self._add(event)
+
+    def may_be_stuck(self) -> bool:
+        """False if none of the StuckDetector scenarios can match the synced history."""
+        actions = list(self.actions)
+        observations = list(self.observations)
+        # scenario 1 (4 same actions and observations) and 2 (3 same actions, errors)
+        if _repeats(actions, 3) and (
+            _repeats(observations, 4)
+            or (
+                len(self.observation_kinds) >= 3
+                and self.observation_kinds[-1] is not None
+                and _repeats(list(self.observation_kinds), 3)
+            )
+        ):
+            return True
+        # scenario 3: the same agent message three times without observations in between
+        if (
+            _repeats(list(self.agent_messages), 3)
+            and not self.observation_before_message[-1]
+            and not self.observation_before_message[-2]
+        ):
+            return True
+        # scenario 4: alternating actions and observations over the last six steps
+        if (
+            _repeats(actions, 3, step=2)
+            and _repeats(actions[:-1], 3, step=2)
+            and _repeats(observations, 3, step=2)
+            and _repeats(observations[:-1], 3, step=2)
+        ):
+            return True
+        # scenario 5: consecutive condensation observations among the last ten
+        if self.condensations >= CONDENSATION_LOOP_LENGTH and any(
+            self.condensation_follows
+        ):
+            return True
+        return False
@@ -0,0 +1,7 @@
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate: ~4 ASCII characters per token, ~1 token per other (e.g. CJK) character."""
+    if text.isascii():
+        return (len(text) + 3) // 4
+    # encode() drops the non-ASCII characters in C, without a Python-level loop
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
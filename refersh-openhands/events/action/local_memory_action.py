@@ -21,15 +21,23 @@ class RecallTaskAction(Action):
     """
     Action to recall task(s) from memory.
     If title is provided, recalls specific task.
-    If title is None, recalls the outline (all titles).
+    If query is provided (and no title), searches memories by keywords.
+    If both are None, recalls the outline (all titles).
     """
     # 2. 修改为 Optional[str]
     title: Optional[str] = field(default=None)
+    query: Optional[str] = field(default=None)
+    # 大记忆分块召回: 指定块序号 (从 0 开始), 或起始偏移与最大字符数
+    chunk: Optional[int] = field(default=None)
+    offset: Optional[int] = field(default=None)
+    max_chars: Optional[int] = field(default=None)
     action: str = "recall_task"
 
     @property
     def message(self) -> str:
         if self.title:
             return f"Recalling specific task '{self.title}' from memory..."
+        elif self.query:
+            return f"Searching memory for '{self.query}'..."
         else:
             return "Recalling memory outline (all titles)..."
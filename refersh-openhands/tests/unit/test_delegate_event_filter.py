@@ -0,0 +1,127 @@
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from openhands.controller.agent_controller import AgentController
+from openhands.events.action import CmdRunAction, MessageAction
+from openhands.events.action.agent import AgentDelegateAction
+from openhands.events.event import Event
+from openhands.events.observation import CmdOutputObservation
+from openhands.events.observation.delegate import AgentDelegateObservation
+
+
+def with_ids(events: list[Event]) -> list[Event]:
+    for i, event in enumerate(events):
+        event._id = i  # type: ignore[attr-defined]
+    return events
+
+
+def delegate() -> AgentDelegateAction:
+    return AgentDelegateAction(agent='BrowsingAgent', inputs={'task': 'browse'})
+
+
+def delegate_done() -> AgentDelegateObservation:
+    return AgentDelegateObservation(content='done', outputs={})
+
+
+def step(i: int) -> list[Event]:
+    return [
+        CmdRunAction(command=f'cmd {i}'),
+        CmdOutputObservation(content=f'out {i}', command=f'cmd {i}'),
+    ]
+
+
+def filter_ids(events: list[Event], controller=None) -> list[int]:
+    controller = controller or SimpleNamespace(log=MagicMock())
+    return [e.id for e in AgentController._filter_delegate_events(controller, events)]
+
+
+def test_drops_events_of_each_delegation():
+    events = with_ids(
+        [MessageAction(content='task')]  # 0
+        + [delegate()]  # 1
+        + step(0)  # 2, 3
+        + [delegate_done()]  # 4
+        + step(1)  # 5, 6
+        + [delegate()]  # 7
+        + step(2)  # 8, 9
+        + [delegate_done()]  # 10
+    )
+
+    assert filter_ids(events) == [0, 1, 4, 5, 6, 7, 10]
+
+
+def test_nested_delegation_is_dropped_with_the_enclosing_one():
+    events = with_ids(
+        [MessageAction(content='task')]  # 0
+        + [delegate()]  # 1
+        + step(0)  # 2, 3
+        + [delegate()]  # 4
+        + step(1)  # 5, 6
+        + [delegate_done()]  # 7
+        + step(2)  # 8, 9
+        + [delegate_done()]  # 10
+        + step(3)  # 11, 12
+    )
+
+    assert filter_ids(events) == [0, 1, 10, 11, 12]
+
+
+def test_unmatched_delegate_action_keeps_the_events_after_it():
+    # the delegate is still running: its events are kept, but a nested delegation
+    # that finished is filtered
+    events = with_ids(
+        [MessageAction(content='task')]  # 0
+        + [delegate()]  # 1
+        + step(0)  # 2, 3
+        + [delegate()]  # 4
+        + step(1)  # 5, 6
+        + [delegate_done()]  # 7
+        + step(2)  # 8, 9
+    )
+
+    assert filter_ids(events) == [0, 1, 2, 3, 4, 7, 8, 9]
+
+
+def test_orphan_delegate_observation_is_kept_and_logged():
+    controller = SimpleNamespace(log=MagicMock())
+    events = with_ids(
+        step(0)  # 0, 1
+        + [delegate_done()]  # 2
+        + [delegate()]  # 3
+        + step(1)  # 4, 5
+        + [delegate_done()]  # 6
+    )
+
+    assert filter_ids(events, controller) == [0, 1, 2, 3, 6]
+    controller.log.assert_called_once()
+    assert controller.log.call_args.args[0] == 'warning'
+
+
+def test_filters_a_long_history_with_many_delegations_in_one_pass():
+    # 100k events with 300 delegations of ~160 events each; the old per-range
+    # rescans made this O(events x delegations)
+    events: list[Event] = [MessageAction(content='task')]
+    expected_kept = 1
+    i = 0
+    while len(events) < 100_000:
+        if i % 2 == 0 and i < 600:
+            events.append(delegate())
+            for j in range(80):
+                events.extend(step(j))
+            events.append(delegate_done())
+            expected_kept += 2
+        else:
+            for j in range(80):
+                events.extend(step(j))
+            expected_kept += 160
+        i += 1
+    with_ids(events)
+
+    start = time.perf_counter()
+    kept = filter_ids(events)
+    elapsed = time.perf_counter() - start
+
+    assert len(kept) == expected_kept
+    assert kept == sorted(kept)
+    assert elapsed < 2.0, f'filtering {len(events)} events took {elapsed:.2f}s'
@@ -0,0 +1,120 @@
+import asyncio
+import copy
+import logging
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from openhands.controller.agent_controller import AgentController
+from openhands.core.logger import openhands_logger
+from openhands.core.schema import AgentState
+from openhands.events.observation import BrowserOutputObservation, CmdOutputObservation
+
+MAX_MESSAGE_CHARS = 30_000
+
+
+@pytest.fixture
+def log_level():
+    level = openhands_logger.level
+
+    def set_level(new_level: int) -> None:
+        openhands_logger.setLevel(new_level)
+
+    yield set_level
+    openhands_logger.setLevel(level)
+
+
+@pytest.fixture
+def controller():
+    return SimpleNamespace(
+        agent=SimpleNamespace(
+            llm=SimpleNamespace(
+                config=SimpleNamespace(max_message_chars=MAX_MESSAGE_CHARS),
+                metrics=MagicMock(),
+            )
+        ),
+        _pending_action=None,
+        state=SimpleNamespace(agent_state=AgentState.RUNNING),
+        log=MagicMock(),
+    )
+
+
+def browser_observation() -> BrowserOutputObservation:
+    # roughly what a browsing step produces: a large screenshot, accessibility
+    # tree and page content
+    return BrowserOutputObservation(
+        content='page text ' * 5_000,
+        url='http://localhost/',
+        trigger_by_action='browse_interactive',
+        screenshot='data:image/png;base64,' + 'A' * 2_000_000,
+        axtree_object={
+            'nodes': [
+                {'nodeId': str(i), 'role': {'value': 'generic'}, 'childIds': [str(i + 1)]}
+                for i in range(5_000)
+            ]
+        },
+    )
+
+
+def handle(controller, observation) -> None:
+    asyncio.run(AgentController._handle_observation(controller, observation))
+
+
+def test_observation_is_not_formatted_when_debug_logging_is_off(controller, log_level):
+    log_level(logging.INFO)
+    observation = browser_observation()
+
+    with patch.object(copy, 'deepcopy') as deepcopy, patch.object(copy, 'copy') as shallow_copy:
+        handle(controller, observation)
+
+    deepcopy.assert_not_called()
+    shallow_copy.assert_not_called()
+    controller.log.assert_not_called()
+
+
+def test_long_observation_is_logged_truncated_without_changing_the_event(
+    controller, log_level
+):
+    log_level(logging.DEBUG)
+    content = 'output line\n' * 5_000
+    observation = CmdOutputObservation(content=content, command='cat big.log')
+
+    with patch.object(copy, 'deepcopy', side_effect=AssertionError('deepcopy')):
+        handle(controller, observation)
+
+    assert observation.content == content
+    controller.log.assert_called_once()
+    level, message = controller.log.call_args.args
+    assert level == 'debug'
+    assert 'truncated' in message
+    assert len(message) < len(content)
+
+
+def test_handling_is_much_cheaper_than_a_deepcopy(controller, log_level):
+    # microbenchmark of the old per-observation deepcopy against the current path
+    log_level(logging.DEBUG)
+    observation = browser_observation()
+    runs = 20
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        copy.deepcopy(observation)
+    deepcopy_time = (time.perf_counter() - start) / runs
+
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.perf_counter()
+        for _ in range(runs):
+            loop.run_until_complete(
+                AgentController._handle_observation(controller, observation)
+            )
+        handle_time = (time.perf_counter() - start) / runs
+    finally:
+        loop.close()
+
+    assert handle_time < deepcopy_time / 5, (
+        f'_handle_observation: {handle_time * 1e3:.2f} ms, '
+        f'deepcopy: {deepcopy_time * 1e3:.2f} ms'
+    )
@@ -0,0 +1,113 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from openhands.controller.agent_controller import AgentController
+from openhands.controller.history_snapshot import (
+    load_history_snapshot,
+    write_history_snapshot,
+)
+from openhands.events import EventSource, EventStream
+from openhands.events.action import AgentDelegateAction, CmdRunAction
+from openhands.events.event_filter import EventFilter
+from openhands.events.observation import AgentDelegateObservation, CmdOutputObservation
+from openhands.storage.memory import InMemoryFileStore
+
+SNAPSHOT_PATH = 'sessions/test/controller_history_snapshot.json'
+
+
+@pytest.fixture
+def event_stream():
+    stream = EventStream(sid='test', file_store=InMemoryFileStore({}))
+    for i in range(3):
+        stream.add_event(CmdRunAction(command=f'cmd {i}'), EventSource.AGENT)
+        stream.add_event(
+            CmdOutputObservation(content=f'out {i}', command=f'cmd {i}'),
+            EventSource.ENVIRONMENT,
+        )
+    yield stream
+    stream.close()
+
+
+def restore(event_stream: EventStream) -> list[int]:
+    controller = SimpleNamespace(
+        _snapshot_interval=1,
+        is_delegate=False,
+        event_stream=event_stream,
+        _snapshot_path=SNAPSHOT_PATH,
+        agent_history_filter=EventFilter(exclude_hidden=True),
+        log=lambda *args, **kwargs: None,
+    )
+    controller._filter_delegate_events = (
+        lambda events: AgentController._filter_delegate_events(controller, events)
+    )
+    events = AgentController._load_history_snapshot(
+        controller, 0, event_stream.get_latest_event_id()
+    )
+    assert events is not None
+    return [event.id for event in events]
+
+
+def test_snapshot_records_highest_id_of_out_of_order_history(event_stream):
+    # e.g. observations that arrived in a different order than their ids
+    history = [event_stream.get_event(i) for i in (0, 1, 3, 2)]
+
+    write_history_snapshot(
+        event_stream.file_store, SNAPSHOT_PATH, history, start_id=0
+    )
+
+    snapshot = load_history_snapshot(event_stream.file_store, SNAPSHOT_PATH)
+    assert snapshot['history_ids'] == [0, 1, 3, 2]
+    assert snapshot['last_event_id'] == 3
+    assert snapshot['open_delegate_index'] == 4
+
+
+def test_restore_out_of_order_history_does_not_duplicate_events(event_stream):
+    history = [event_stream.get_event(i) for i in (0, 1, 3, 2)]
+    write_history_snapshot(
+        event_stream.file_store, SNAPSHOT_PATH, history, start_id=0
+    )
+
+    assert restore(event_stream) == [0, 1, 3, 2, 4, 5]
+
+
+def test_snapshot_of_an_older_version_is_ignored(event_stream):
+    event_stream.file_store.write(
+        SNAPSHOT_PATH,
+        json.dumps(
+            {
+                'version': 1,
+                'start_id': 0,
+                'last_event_id': 2,
+                'iteration': 2,
+                'history_ids': [0, 1, 3, 2],
+            }
+        ),
+    )
+
+    assert load_history_snapshot(event_stream.file_store, SNAPSHOT_PATH) is None
+
+
+def test_restore_filters_a_delegation_that_finished_after_the_snapshot(event_stream):
+    event_stream.add_event(
+        AgentDelegateAction(agent='BrowsingAgent', inputs={'task': 'browse'}),
+        EventSource.AGENT,
+    )  # 6
+    history = [event_stream.get_event(i) for i in range(7)]
+    write_history_snapshot(event_stream.file_store, SNAPSHOT_PATH, history, start_id=0)
+    # the delegate's own events, then its result
+    event_stream.add_event(CmdRunAction(command='delegate cmd'), EventSource.AGENT)
+    event_stream.add_event(
+        CmdOutputObservation(content='delegate out', command='delegate cmd'),
+        EventSource.ENVIRONMENT,
+    )
+    event_stream.add_event(
+        AgentDelegateObservation(content='done', outputs={}), EventSource.AGENT
+    )  # 9
+    event_stream.add_event(CmdRunAction(command='cmd 3'), EventSource.AGENT)  # 10
+
+    snapshot = load_history_snapshot(event_stream.file_store, SNAPSHOT_PATH)
+    assert snapshot['open_delegate_index'] == 6
+
+    assert restore(event_stream) == [0, 1, 2, 3, 4, 5, 6, 9, 10]
@@ -0,0 +1,218 @@
+import random
+
+import pytest
+
+from openhands.controller.state.state import State
+from openhands.controller.stuck import StuckDetector
+from openhands.controller.stuck_fingerprints import LoopFingerprints
+from openhands.events import EventSource
+from openhands.events.action import (
+    CmdRunAction,
+    IPythonRunCellAction,
+    MessageAction,
+    NullAction,
+)
+from openhands.events.event import Event
+from openhands.events.observation import (
+    CmdOutputObservation,
+    ErrorObservation,
+    IPythonRunCellObservation,
+    NullObservation,
+)
+from openhands.events.observation.agent import AgentCondensationObservation
+from openhands.events.observation.commands import CmdOutputMetadata
+
+SYNTAX_ERROR = (
+    'Cell In[1], line 1\n'
+    'x\n'
+    '^\n'
+    'foo\n'
+    'bar\n'
+    'SyntaxError: invalid syntax. Perhaps you forgot a comma?\n'
+    '[Jupyter current working directory: /workspace]\n'
+    '[Jupyter Python interpreter: /openhands/poetry/bin/python]'
+)
+
+
+def user_message(content: str = 'do the task') -> MessageAction:
+    message = MessageAction(content=content)
+    message._source = EventSource.USER  # type: ignore[attr-defined]
+    return message
+
+
+def agent_message(content: str) -> MessageAction:
+    message = MessageAction(content=content)
+    message._source = EventSource.AGENT  # type: ignore[attr-defined]
+    return message
+
+
+def cmd(command: str, exit_code: int = 0, pid: int = 1) -> list[Event]:
+    return [
+        CmdRunAction(command=command),
+        CmdOutputObservation(
+            content='output',
+            command=command,
+            metadata=CmdOutputMetadata(exit_code=exit_code, pid=pid),
+        ),
+    ]
+
+
+def cmd_error(command: str, error: str = 'error') -> list[Event]:
+    return [CmdRunAction(command=command), ErrorObservation(content=error)]
+
+
+def ipython_syntax_error() -> list[Event]:
+    return [
+        IPythonRunCellAction(code='x = (1 2)'),
+        IPythonRunCellObservation(content=SYNTAX_ERROR, code='x = (1 2)'),
+    ]
+
+
+# (name, events, StuckDetector result in headless mode)
+SCENARIOS: list[tuple[str, list[Event], bool]] = [
+    # 1. the same action and observation four times
+    # (outputs are compared by command and exit code, pids may differ)
+    ('repeating_action_observation', sum((cmd('ls', pid=i) for i in range(4)), []), True),
+    ('repeating_action_observation_three_times', sum((cmd('ls') for _ in range(3)), []), False),
+    (
+        'repeating_action_observation_last_differs',
+        sum((cmd('ls') for _ in range(3)), []) + cmd('ls', exit_code=1),
+        False,
+    ),
+    # 2. the same action three times, with errors
+    ('repeating_action_error', sum((cmd_error('ls') for _ in range(3)), []), True),
+    ('repeating_ipython_syntax_error', sum((ipython_syntax_error() for _ in range(3)), []), True),
+    (
+        'repeating_action_error_last_action_differs',
+        sum((cmd_error('ls') for _ in range(2)), []) + cmd_error('pwd'),
+        False,
+    ),
+    # 3. the same agent message three times without observations
+    ('monologue', [agent_message('thinking') for _ in range(3)], True),
+    (
+        'monologue_with_an_observation',
+        [agent_message('thinking'), agent_message('thinking')]
+        + cmd('ls')
+        + [agent_message('thinking')],
+        False,
+    ),
+    (
+        'monologue_different_messages',
+        [agent_message('thinking'), agent_message('thinking'), agent_message('done')],
+        False,
+    ),
+    # 4. two alternating actions and observations over the last six steps
+    ('action_observation_pattern', (cmd('ls') + cmd('pwd')) * 3, True),
+    (
+        'action_observation_pattern_broken',
+        (cmd('ls') + cmd('pwd')) * 2 + cmd('ls') + cmd('whoami'),
+        False,
+    ),
+    # 5. consecutive condensation observations among the last ten
+    (
+        'context_window_error_loop',
+        cmd('ls') + [AgentCondensationObservation('summary') for _ in range(10)],
+        True,
+    ),
+    (
+        'condensations_with_actions_between',
+        sum(
+            ([AgentCondensationObservation('summary'), CmdRunAction(command=f'cmd {i}')] for i in range(10)),
+            [],
+        ),
+        False,
+    ),
+    (
+        'nine_consecutive_condensations',
+        cmd('ls') + [AgentCondensationObservation('summary') for _ in range(9)],
+        False,
+    ),
+    # user messages and null events are ignored by both
+    (
+        'repeating_with_null_events',
+        sum((cmd('ls') + [NullAction(), NullObservation('')] for _ in range(4)), []),
+        True,
+    ),
+]
+
+
+def check_history(events: list[Event], headless_mode: bool) -> bool:
+    """Appends events one by one; LoopFingerprints must never rule out a detected loop."""
+    state = State(inputs={}, max_iterations=50)
+    detector = StuckDetector(state)
+    fingerprints = LoopFingerprints()
+    stuck = False
+    for i, event in enumerate(events):
+        event._id = i  # type: ignore[attr-defined]
+        state.history.append(event)
+        fingerprints.sync(state.history)
+        stuck = detector.is_stuck(headless_mode)
+        if stuck:
+            assert fingerprints.may_be_stuck(), f'missed a loop at event {i}'
+    return stuck
+
+
+@pytest.mark.parametrize('headless_mode', [True, False])
+@pytest.mark.parametrize(
+    'events, expected', [(events, expected) for _, events, expected in SCENARIOS],
+    ids=[name for name, _, _ in SCENARIOS],
+)
+def test_fingerprints_never_miss_a_stuck_scenario(events, expected, headless_mode):
+    # in interactive mode the detector only looks after the last user message
+    history = [user_message()] + events
+    assert check_history(history, headless_mode) == expected
+
+
+@pytest.mark.parametrize('headless_mode', [True, False])
+def test_loop_before_the_last_user_message(headless_mode):
+    history = sum((cmd('ls') for _ in range(4)), []) + [user_message('try again')] + cmd('ls')
+    # interactive mode ignores the loop before the user message, headless mode does not
+    assert check_history(history, headless_mode) == headless_mode
+
+
+def test_fingerprints_rule_out_loops_without_repeats():
+    fingerprints = LoopFingerprints()
+    history: list[Event] = [user_message()] + sum(
+        (cmd(f'cmd {i}') for i in range(20)), []
+    )
+    for i, event in enumerate(history):
+        event._id = i  # type: ignore[attr-defined]
+    fingerprints.sync(history)
+    assert not fingerprints.may_be_stuck()
+
+
+def random_event(rng: random.Random) -> Event:
+    kind = rng.randrange(10)
+    if kind == 0:
+        return CmdRunAction(command=rng.choice(['ls', 'pwd']))
+    if kind == 1:
+        return CmdOutputObservation(
+            content=rng.choice(['a', 'b']),
+            command=rng.choice(['ls', 'pwd']),
+            metadata=CmdOutputMetadata(exit_code=rng.choice([0, 1]), pid=rng.randint(1, 3)),
+        )
+    if kind == 2:
+        return IPythonRunCellAction(
+            code=rng.choice(['x=1', 'edit_file_by_replace(\na\nb\nc', 'edit_file_by_replace(\na\nb\nd'])
+        )
+    if kind == 3:
+        return IPythonRunCellObservation(content=rng.choice([SYNTAX_ERROR, 'ok']), code='x')
+    if kind == 4:
+        return ErrorObservation(rng.choice(['e', 'f']))
+    if kind == 5:
+        return agent_message(rng.choice(['hi', 'yo']))
+    if kind == 6:
+        return user_message()
+    if kind == 7:
+        return NullAction()
+    if kind == 8:
+        return NullObservation('')
+    return AgentCondensationObservation('summary')
+
+
+@pytest.mark.parametrize('headless_mode', [True, False])
+def test_fingerprints_never_miss_a_loop_in_random_histories(headless_mode):
+    for seed in range(200):
+        rng = random.Random(seed)
+        history = [random_event(rng) for _ in range(rng.randint(1, 80))]
+        check_history(history, headless_mode)
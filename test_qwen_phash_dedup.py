@@ -0,0 +1,79 @@
+"""
+Checks for the perceptual-hash dedup in qwen_mcp_server (no API calls are made).
+Run with: python -m pytest test_qwen_phash_dedup.py
+"""
+import pytest
+
+PIL = pytest.importorskip("PIL")
+from PIL import Image, ImageDraw
+
+import qwen_mcp_server as server
+
+
+def make_page(text=None, extra=None):
+    image = Image.new("RGB", (1280, 800), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, 1280, 40), fill=(40, 40, 80))
+    draw.text((20, 100), "Title of the page", fill="black")
+    if text:
+        draw.text((20, 300), text, fill="black")
+    if extra:
+        extra(draw)
+    return image
+
+
+@pytest.fixture
+def dedup(monkeypatch):
+    calls = []
+
+    def fake_call(prompt, image):
+        calls.append(image)
+        return f"answer {len(calls)}"
+
+    monkeypatch.setattr(server, "PHASH_DEDUP_ENABLED", True)
+    monkeypatch.setattr(server, "PHASH_INDEX", server.PerceptualHashIndex(8, server.PHASH_MAX_DISTANCE))
+    monkeypatch.setattr(server, "call_qwen_vl_api", fake_call)
+    return calls
+
+
+def analyze(image):
+    return server.analyze_image("Describe the page", server.image_to_data_uri(image, "PNG"))
+
+
+def test_blank_page_and_page_with_text_do_not_match(dedup):
+    blank = Image.new("RGB", (1280, 800), "white")
+    with_text = blank.copy()
+    ImageDraw.Draw(with_text).text((20, 300), "A line of text was added here", fill="black")
+
+    analyze(blank)
+    answer, metadata = analyze(with_text)
+
+    assert answer == "answer 2"
+    assert metadata == {}
+    assert len(dedup) == 2
+
+
+def test_small_text_change_does_not_match(dedup):
+    analyze(make_page())
+    answer, metadata = analyze(make_page(text="Save"))
+
+    assert answer == "answer 2"
+    assert not metadata.get("approximate")
+
+
+def test_cursor_change_reuses_answer(dedup):
+    analyze(make_page())
+    answer, metadata = analyze(make_page(extra=lambda draw: draw.line((300, 300, 300, 316), fill="black")))
+
+    assert metadata["approximate"] is True
+    assert answer.endswith("answer 1")
+    assert len(dedup) == 1
+
+
+def test_different_prompt_does_not_match(dedup):
+    page = server.image_to_data_uri(make_page(), "PNG")
+    server.analyze_image("Describe the page", page)
+    _, metadata = server.analyze_image("List the buttons", page)
+
+    assert metadata == {}
+    assert len(dedup) == 2